@@ -333,13 +333,46 @@ var loadData = function(callback) {
     var files1 = {
         "config": "data/config.json" };
     var files2 = {
-        "structure_raw": "data/structure.json",
         "narratives": "data/narratives.json",
         "pictures": "data/pictures.json" };
     loadDataImpl(files1, function(ret) {
         if (ret!=null) {
+            // Large trees may have the structure split into several files, and
+            // a list of which details file each person is in
+            var structureParts = ret["config"]["partition_structure"] || 1;
+            if (structureParts > 1)
+                for (var i=0; i<structureParts; i++)
+                    files2["structure_raw"+i] = "data/structure"+i+".json";
+            else
+                files2["structure_raw"] = "data/structure.json";
+            if (ret["config"]["partition_mode"] == "family")
+                files2["partitions"] = "data/partitions.json";
             var nextBatch = function() { loadDataImpl(files2, function (ret2) {
                 if (ret2!=null) {
+                    if (ret["config"]["data_format"] == "columnar") {
+                        if (structureParts > 1)
+                            for (var i=0; i<structureParts; i++)
+                                ret2["structure_raw"+i] = decodeStructure(ret2["structure_raw"+i]);
+                        else
+                            ret2["structure_raw"] = decodeStructure(ret2["structure_raw"]);
+                    }
+                    if (structureParts > 1) {
+                        var structure_raw = [];
+                        for (var i=0; i<structureParts; i++) {
+                            var part = ret2["structure_raw"+i];
+                            for (var j=0; j<part.length; j++)
+                                structure_raw.push(part[j]);
+                            delete ret2["structure_raw"+i];
+                        }
+                        ret2["structure_raw"] = sortNameIndex(structure_raw);
+                    }
+                    if (ret2["partitions"]) {
+                        var partitions = {};
+                        for (var i=0; i<ret2["partitions"].length; i++)
+                            for (var j=0; j<ret2["partitions"][i].length; j++)
+                                partitions[ret2["partitions"][i][j]] = i;
+                        ret2["partitions"] = partitions;
+                    }
 
                     var files={};
 
@@ -355,6 +388,7 @@ var loadData = function(callback) {
                         structure[files["structure_raw"][i]["id"]]=files["structure_raw"][i];
                     files["structure"] = structure;
                     files["details"] = {};
+                    files["citations"] = {};
 
                     callback(files);
                 } else callback(null);
@@ -483,6 +517,143 @@ var displaySurname = function(n) {
     return "UNKNOWN";
 };
 
+// Sort key for the name index: surnames, then other names, as in make-data.py
+var nameIndexKey = function(n) {
+    var names = n.split(" ");
+    var surnames = [];
+    var nonsurnames = [];
+    var insurname = false;
+    for (var i=0; i<names.length; i++) {
+        if (names[i].startsWith("/"))
+            insurname = true;
+
+        if (insurname)
+            surnames.push(names[i].replace(/\//g, ""));
+        else
+            nonsurnames.push(names[i].replace(/\//g, ""));
+
+        if (names[i].endsWith("/") && insurname)
+            insurname = false;
+    }
+    return surnames.concat(nonsurnames);
+};
+
+var sortNameIndex = function(nameindex) {
+    var keyed = jmap(function(person) {return [nameIndexKey(person["name"]), person];}, nameindex);
+    keyed.sort(function(a, b) {
+        for (var i=0; i<a[0].length && i<b[0].length; i++)
+            if (a[0][i] != b[0][i])
+                return a[0][i] < b[0][i] ? -1 : 1;
+        return a[0].length - b[0].length;
+    });
+    return jmap(function(pair) {return pair[1];}, keyed);
+};
+
+// The normalized words of a name that the search index is keyed on, as in make-data.py
+var nameTokens = function(n) {
+    if (n.normalize)
+        n = n.normalize("NFKD");
+    var words = n.replace(/[\u0300-\u036f]/g, "").toLowerCase().split(/[\s\/\-,.()"']+/);
+    var tokens = [];
+    for (var i=0; i<words.length; i++)
+        if (words[i].length > 0)
+            tokens.push(words[i]);
+    return tokens;
+};
+
+// Decoders for data files written by make-data.py with --format columnar
+var decodeStructure = function(columns) {
+    var ids = columns["ids"];
+    var strings = columns["strings"];
+    var toId = function(i) {return ids[i];};
+    var toString = function(i) {return strings[i];};
+    var people = [];
+    for (var i=0; i<columns["id"].length; i++)
+        people.push({
+            "id": ids[columns["id"][i]],
+            "name": columns["name"][i],
+            "sex": columns["sex"][i],
+            "parents": jmap(toId, columns["parents"][i]),
+            "spouses": jmap(toId, columns["spouses"][i]),
+            "children": jmap(toId, columns["children"][i]),
+            "birth": jmap(toString, columns["birth"][i]),
+            "death": jmap(toString, columns["death"][i])
+        });
+    return people;
+};
+
+var decodeDetails = function(columns) {
+    var strings = columns["strings"];
+    var toStrings = function(lst) {
+        return jmap(function(i) {return strings[i];}, lst);
+    };
+    var details = {};
+    for (var i=0; i<columns["id"].length; i++)
+        details[columns["id"][i]] = {
+            "id": columns["id"][i],
+            "names": columns["names"][i],
+            "note": columns["note"][i],
+            // citations are lists of strings, or ids in the citation table
+            "cites": jmap(function(c) {return typeof c == "number" ? strings[c] : toStrings(c);}, columns["cites"][i]),
+            "events": jmap(toStrings, columns["events"][i])
+        };
+    return details;
+};
+
+var detailsPartition = function(data, personId) {
+    if (data["partitions"])
+        return data["partitions"][personId];
+    return Math.abs(java_hashcode(personId)) % data["config"]["partition_details"];
+};
+
+var citationsPartition = function(data, citeId) {
+    return Math.abs(java_hashcode(citeId)) % data["config"]["citation_table"];
+};
+
+// Calls back with the [title, text] of each of the ids in the citation
+// table, downloading the parts of the table that they're in, or with null
+var lookupCitations = function(data, ids, callback) {
+    var citations = data["citations"];
+    var partitions = [];
+    for (var i=0; i<ids.length; i++)
+        if (!(ids[i] in citations))
+            partitions.addonce(citationsPartition(data, ids[i]));
+    var pending = partitions.length;
+    var failed = false;
+    var finish = function() {
+        var cites = [];
+        for (var i=0; i<ids.length; i++) {
+            if (!(ids[i] in citations)) {
+                callback(null);
+                return;
+            }
+            cites.push(citations[ids[i]]);
+        }
+        callback(cites);
+    };
+    if (pending == 0) {
+        finish();
+        return;
+    }
+    for (var i=0; i<partitions.length; i++)
+        fetchStaticJson("data/cites"+partitions[i]+".json", function(js) {
+            if (js == null)
+                failed = true;
+            else {
+                var titles = js["titles"];
+                for (var j=0; j<js["id"].length; j++)
+                    citations[js["id"][j]] = [titles[js["title"][j]], js["text"][j]];
+            }
+            pending--;
+            if (pending == 0) {
+                if (failed)
+                    callback(null);
+                else
+                    finish();
+            }
+        }, xhrTimeout);
+};
+
 var flattenTree = function(node) {
     var all = [];
     var flattenTreeHelper = function(node) {
@@ -2791,11 +2962,9 @@ var getDetails = function(view, data, person, defaultPane) {
         });
     };
 
-    var makeCitesPane = function() {
-        var div = document.createElement('div');
-        div.className = 'detaildatacontainer';
-        for (var i=0; i<person["cites"].length; i++) {
-            var cite = person["cites"][i];
+    var fillCitesPane = function(div, cites) {
+        for (var i=0; i<cites.length; i++) {
+            var cite = cites[i];
             var title = cite[0];
             var text = cite[1];
             var entry = document.createElement('div');
@@ -2817,6 +2986,32 @@ var getDetails = function(view, data, person, defaultPane) {
             subentry.appendChild(entry_content);
             div.appendChild(entry);
         }
+    };
+
+    var makeCitesPane = function() {
+        var div = document.createElement('div');
+        div.className = 'detaildatacontainer';
+        if (!data["config"]["citation_table"]) {
+            fillCitesPane(div, person["cites"]);
+            return div;
+        }
+        // the citations are only ids, so look them up when the pane is shown
+        var loading = false;
+        div.loadContent = function() {
+            if (loading)
+                return;
+            loading = true;
+            makeEmpty(div);
+            div.appendChild(document.createTextNode("Loading, please wait."));
+            lookupCitations(data, person["cites"], function(cites) {
+                makeEmpty(div);
+                if (cites == null) {
+                    loading = false;
+                    div.appendChild(document.createTextNode("Citations aren't accessible right now. Make sure you are connected to the internet."));
+                } else
+                    fillCitesPane(div, cites);
+            });
+        };
         return div;
     };
 
@@ -2839,6 +3034,8 @@ var getDetails = function(view, data, person, defaultPane) {
         content_container.appendChild(divtable[evt.currentTarget.getAttribute("data-mydiv")]);
         if (divtable[evt.currentTarget.getAttribute("data-mydiv")].loadThumbnails)
             divtable[evt.currentTarget.getAttribute("data-mydiv")].loadThumbnails();
+        if (divtable[evt.currentTarget.getAttribute("data-mydiv")].loadContent)
+            divtable[evt.currentTarget.getAttribute("data-mydiv")].loadContent();
         pulsate(evt.currentTarget);
     };
     var makeButton = function(title, div) {
@@ -2886,6 +3083,8 @@ var getDetails = function(view, data, person, defaultPane) {
         content_container.appendChild(divtable[extrabuttons[defaultPane].getAttribute("data-mydiv")]);
         if (divtable[extrabuttons[defaultPane].getAttribute("data-mydiv")].loadThumbnails)
             divtable[extrabuttons[defaultPane].getAttribute("data-mydiv")].loadThumbnails();
+        if (divtable[extrabuttons[defaultPane].getAttribute("data-mydiv")].loadContent)
+            divtable[extrabuttons[defaultPane].getAttribute("data-mydiv")].loadContent();
         pulsate(extrabuttons[defaultPane]);
     }
 
@@ -3332,11 +3531,16 @@ var View = function(data) {
                 callback(details[personId]);
                 return;
             }
-            var bucket = Math.abs(java_hashcode(personId)) % config["partition_details"];
-            fetchStaticJsonWithLoadingPanel("data/details"+bucket+".json", function(js) {
+            // serve-data.py makes a file for each person, instead of partitions
+            var addr = config["details_mode"] == "person" ?
+                "data/details/"+encodeURIComponent(personId)+".json" :
+                "data/details"+detailsPartition(data, personId)+".json";
+            fetchStaticJsonWithLoadingPanel(addr, function(js) {
                 if (js == null) {
                     callback(null);
                 } else {
+                    if (config["data_format"] == "columnar")
+                        js = decodeDetails(js);
                     var newvalues = Object.keys(js);
                     for (var i=0; i<newvalues.length; i++)
                         details[newvalues[i]] = js[newvalues[i]];
@@ -4088,6 +4292,43 @@ var generateNarrative = function(data, spec) {
     return {"name":spec["name"],"indvs":newnarrative,"emptybios":spec["emptybios"]};
 };
 
+// make-data.py works out who's in each narrative ahead of time, and puts
+// them in narratives.json, or in a file for each narrative that's fetched
+// when it's opened. Narratives that weren't made that way are generated here.
+var lookupNarrative = function(data, narrname, callback) {
+    var narratives = data["narratives"];
+    var which = -1;
+    if (narrname != "other") {
+        for (var i=0; i<narratives["spec"].length; i++)
+            if (narratives["spec"][i]["name"] == narrname) {
+                which = i;
+                break;
+            }
+        if (which < 0) {
+            callback(null);
+            return;
+        }
+    }
+    var makeNarrative = function(indvs) {
+        if (which >= 0) {
+            var spec = narratives["spec"][which];
+            return {"name":spec["name"],"indvs":indvs,"emptybios":spec["emptybios"]};
+        }
+        var narrative = [];
+        for (var i=0; i<indvs.length; i++)
+            narrative.push({"id": indvs[i], "indent":0, "gen":[]});
+        return {"name":"Other","indvs":narrative,"emptybios":false};
+    };
+    if (narratives["partitioned"]) {
+        fetchStaticJson("data/narrative"+(which < 0 ? "other" : which)+".json", function(js) {
+            callback(js == null ? null : makeNarrative(js));
+        }, xhrTimeout);
+    } else if (narratives["members"])
+        callback(makeNarrative(which < 0 ? narratives["other"] : narratives["members"][which]));
+    else
+        callback(which < 0 ? generateOtherNarrative(data) : generateNarrative(data, narratives["spec"][which]));
+};
+
 var getGallerySelectionsForEveryone = function(data) {
     return {"indvs":data["structure_raw"], "name":"Everyone"};
 };
@@ -4317,7 +4558,9 @@ var initNarrative = function(data, view) {
     var narrativeClickHandler = function(evt) {
         if (evt.target.hasAttribute("data-narr")) {
             var which = evt.target.getAttribute("data-narr");
-            showNarrative(data, view, generateNarrative(data, getNarrSpecFromData(data, which)));
+            lookupNarrative(data, which, function(narr) {
+                showNarrative(data, view, narr);
+            });
             evt.stopPropagation();
             return false;
         }
@@ -4671,14 +4914,89 @@ var initSearch = function(data, searchtext, searchlist, searchHandler) {
     };
     searchlist.addEventListener("mousedown",searchResultEventListener);
 
-    searchtext.addEventListener("input",function(evt) {
-        while (searchlist.firstChild) {
-            searchlist.removeChild(searchlist.firstChild);
-        }        
-        if (searchtext.value.length < 3)
+    // Search index shards, named by the prefix of the name tokens in them
+    var shards = data["config"]["search_shards"] || [];
+    var loadedShards = {};
+    var position = {};
+    for (var i=0; i<nameindex.length; i++)
+        position[nameindex[i]["id"]] = i;
+
+    var shardsFor = function(word) {
+        var result = [];
+        for (var i=0; i<shards.length; i++)
+            if (shards[i].startsWith(word) || word.startsWith(shards[i]))
+                result.push(i);
+        return result;
+    };
+
+    // Ids of everyone with a name token beginning with word, from the loaded shards
+    var lookupWord = function(word) {
+        var ids = {};
+        var wanted = shardsFor(word);
+        for (var s=0; s<wanted.length; s++) {
+            var shard = loadedShards[wanted[s]];
+            var lo = 0;
+            var hi = shard.length;
+            while (lo < hi) {
+                var mid = (lo + hi) >> 1;
+                if (shard[mid][0] < word)
+                    lo = mid + 1;
+                else
+                    hi = mid;
+            }
+            for (var i=lo; i<shard.length && shard[i][0].startsWith(word); i++)
+                for (var j=0; j<shard[i][1].length; j++)
+                    ids[shard[i][1][j]] = true;
+        }
+        return ids;
+    };
+
+    var indexedSearch = function(text, callback) {
+        var words = nameTokens(text);
+        var missing = {};
+        for (var w=0; w<words.length; w++) {
+            var wanted = shardsFor(words[w]);
+            for (var s=0; s<wanted.length; s++)
+                if (!(wanted[s] in loadedShards))
+                    missing[wanted[s]] = "data/search"+wanted[s]+".json";
+        }
+        if (Object.keys(missing).length > 0) {
+            loadDataImpl(missing, function(ret) {
+                if (ret == null) {
+                    callback([]);
+                    return;
+                }
+                var retkeys = Object.keys(ret);
+                for (var i=0; i<retkeys.length; i++)
+                    loadedShards[retkeys[i]] = ret[retkeys[i]];
+                indexedSearch(text, callback);
+            });
+            return;
+        }
+        if (words.length == 0) {
+            callback([]);
             return;
-        var words = searchtext.value.toLowerCase().split(" ");
-        var somematch=false;
+        }
+        var matches = lookupWord(words[0]);
+        for (var w=1; w<words.length; w++) {
+            var others = lookupWord(words[w]);
+            var ids = Object.keys(matches);
+            for (var i=0; i<ids.length; i++)
+                if (!(ids[i] in others))
+                    delete matches[ids[i]];
+        }
+        var found = [];
+        var ids = Object.keys(matches);
+        for (var i=0; i<ids.length; i++)
+            if (ids[i] in position)
+                found.push(position[ids[i]]);
+        found.sort(function(a, b) {return a - b;});
+        callback(jmap(function(i) {return nameindex[i];}, found));
+    };
+
+    var linearSearch = function(text) {
+        var words = text.toLowerCase().split(" ");
+        var found = [];
         for (var i=0; i<nameindex.length; i++)
         {
             var name = displayName(nameindex[i]["name"]).toLowerCase();
@@ -4693,26 +5011,53 @@ var initSearch = function(data, searchtext, searchlist, searchHandler) {
                     break;
                 }
             }
-            if (match) {
-                somematch=true;
-                searchlist.style.display = "block";
-                if (searchlist.scrollIntoView)
-                    searchlist.scrollIntoView();
-
-                var el = document.createElement('div');
-                el.className = "searchresult";
-                var lifefrom = nameindex[i]["birth"][0];
-                var lifeto = nameindex[i]["death"][0];
-                var range="";
-                if (lifefrom || lifeto)
-                    range = " ("+lifefrom+"-"+lifeto+")";
-                el.textContent=displayName(nameindex[i]["name"]) + range;
-                el.setAttribute("data-search_id",nameindex[i]["id"]);
-                searchlist.appendChild(el);
+            if (match)
+                found.push(nameindex[i]);
+        }
+        return found;
+    };
+
+    var showResults = function(found) {
+        while (searchlist.firstChild) {
+            searchlist.removeChild(searchlist.firstChild);
+        }
+        if (found.length == 0) {
+            searchlist.style.display="none";
+            return;
+        }
+        searchlist.style.display = "block";
+        if (searchlist.scrollIntoView)
+            searchlist.scrollIntoView();
+        for (var i=0; i<found.length; i++) {
+            var el = document.createElement('div');
+            el.className = "searchresult";
+            var lifefrom = found[i]["birth"][0];
+            var lifeto = found[i]["death"][0];
+            var range="";
+            if (lifefrom || lifeto)
+                range = " ("+lifefrom+"-"+lifeto+")";
+            el.textContent=displayName(found[i]["name"]) + range;
+            el.setAttribute("data-search_id",found[i]["id"]);
+            searchlist.appendChild(el);
+        }
+    };
+
+    searchtext.addEventListener("input",function(evt) {
+        var text = searchtext.value;
+        if (text.length < 3) {
+            while (searchlist.firstChild) {
+                searchlist.removeChild(searchlist.firstChild);
             }
+            return;
         }
-        if (!somematch)
-            searchlist.style.display="none";  
+        if (shards.length > 0)
+            indexedSearch(text, function(found) {
+                // ignore results for text that has since been changed
+                if (searchtext.value == text)
+                    showResults(found);
+            });
+        else
+            showResults(linearSearch(text));
     });
 
 };
@@ -4788,11 +5133,25 @@ var main = function() {
             var first_person = getArgument("i") || firstPersonFromCookie() || data["config"]["initial_person"];
             var first_layout = null;
 
+            var startView = function() {
+                view.init(first_layout, first_person);
+
+                if (getArgument("bw"))
+                    view.convertToGrayscale();
+                if (getArgument("doPrintMode"))
+                    view.doPrintMode(); 
+            };
+
             if (getArgument("narr")) {
-                if (getArgument("narr")=="other")
-                    showNarrative(data, view, generateOtherNarrative(data));
-                else
-                    first_person = showNarrative(data, view, generateNarrative(data, getNarrSpecFromData(data, getArgument("narr")))) || first_person;
+                // the narrative may have to be downloaded first
+                lookupNarrative(data, getArgument("narr"), function(narr) {
+                    if (getArgument("narr")=="other")
+                        showNarrative(data, view, narr);
+                    else
+                        first_person = showNarrative(data, view, narr) || first_person;
+                    startView();
+                });
+                return;
             } else if (getArgument("rnarr")) {
                  first_person = showReverseNarrative(data, view, getArgument("rnarr")) || first_person;
             } else if (getArgument("connection")) {
@@ -4800,12 +5159,7 @@ var main = function() {
                 first_layout = {"style":"connection", "target":who};
             }
 
-            view.init(first_layout, first_person);
-
-            if (getArgument("bw"))
-                view.convertToGrayscale();
-            if (getArgument("doPrintMode"))
-                view.doPrintMode(); 
+            startView();
         }
     });
 };
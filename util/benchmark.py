@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+"""
+Benchmarks for jgedcom and make-data.py, run on synthetic gedcoms of several sizes.
+
+For each size, a gedcom is generated with make-test-gedcom.py (and kept in the
+work directory for later runs), and then measured in a fresh process, so that
+one size's memory use doesn't affect the figures for the next. The stages are
+parsing, some common query chains, building the family graph and querying it,
+building the export records, and a complete run of make-data.py, including the
+stages it reports with --metrics-out. For each, the wall time, CPU time, and
+peak RSS of the process so far are recorded.
+
+Results are written as JSON, so that runs on different commits can be compared:
+
+    ./benchmark.py --sizes 1000,10000 --output before.json
+    (make some changes)
+    ./benchmark.py --sizes 1000,10000 --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import jgedcom
+
+util_dir = os.path.dirname(os.path.abspath(__file__))
+generator_path = os.path.join(util_dir, "make-test-gedcom.py")
+make_data_path = os.path.join(util_dir, "make-data.py")
+
+results_version = 1
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+@contextlib.contextmanager
+def stage(stages, name):
+    """
+    Measure the code in a with block as a stage called name, adding a record
+    of it to stages. The block can add to the record, e.g. a count of items.
+    """
+    record = {"stage": name}
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    yield record
+    record["wall_s"] = round(time.perf_counter() - wall, 4)
+    record["cpu_s"] = round(time.process_time() - cpu, 4)
+    record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    stages.append(record)
+
+# Query chains like the ones make-data.py runs on each individual
+query_chains = [
+    ("names", lambda indi: indi.get_attr('NAME')),
+    ("birth", lambda indi: indi.sub('BIRT').tuple(lambda g: g.get_attr('DATE'), lambda g: g.get_attr('PLAC'))),
+    ("parents", lambda indi: indi.deref('FAMC').get_attr("HUSB","WIFE","SPOU","FATH","MOTH")),
+    ("coparents", lambda indi: indi.deref('FAMS').deref('CHIL').deref('FAMC').get_attr("HUSB","WIFE","SPOU","FATH","MOTH")),
+    ("events", lambda indi: indi.sub('EVEN').attr_equal('TYPE','Arrival').attr_exclude('DATE','').get_attr('PLAC')),
+    ("citations", lambda indi: indi.all().sub('SOUR').foreach_tuple(
+        lambda g: g.deref_value().get_attr('TITL'),
+        lambda g: g.sub('DATA').get_attr('TEXT'),
+        lambda g: g.sub('DATA').sub('TEXT').collect_child_values())),
+]
+
+def load_make_data():
+    spec = importlib.util.spec_from_file_location("make_data", make_data_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_export(gedcom_path, size, export_args):
+    """
+    Run make-data.py on a gedcom in a scratch directory, returning a record of
+    its wall and CPU time, its peak RSS, and the size of what it wrote,
+    followed by the records of its own stages from its --metrics-out report.
+    """
+    scratch = tempfile.mkdtemp(prefix="familyviewer-export-")
+    try:
+        os.mkdir(os.path.join(scratch, "util"))
+        os.mkdir(os.path.join(scratch, "data"))
+        command = [sys.executable, make_data_path, "--gedcom", gedcom_path, "--note", "--citations",
+            "--partition-details", str(max(1, size // 5000)),
+            "--metrics-out", os.path.join(scratch, "metrics.json")] + export_args
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall = time.perf_counter()
+        subprocess.run(command, cwd=os.path.join(scratch, "util"), check=True, stdout=subprocess.DEVNULL)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        data_dir = os.path.join(scratch, "data")
+        with open(os.path.join(scratch, "metrics.json")) as f:
+            metrics = json.load(f)
+        for record in metrics["stages"]:
+            record["stage"] = "export:" + record["stage"]
+        return [{
+            "stage": "export",
+            "wall_s": round(time.perf_counter() - wall, 4),
+            "cpu_s": round(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime, 4),
+            "peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+            "output_bytes": sum(os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir)),
+        }] + metrics["stages"]
+    finally:
+        shutil.rmtree(scratch)
+
+def measure(gedcom_path, size, storage, export_args, skip_export):
+    """
+    Run all the stages on one gedcom, returning a list of their records.
+    This is run in its own process for each size.
+    """
+    stages = []
+    with stage(stages, "parse") as record:
+        gedcom = jgedcom.Gedcom(gedcom_path, storage=storage)
+        record["items"] = len(gedcom.toplevel['children'])
+    individuals = list(gedcom.all().tag('INDI').foreach())
+    for (name, chain) in query_chains:
+        with stage(stages, "query:" + name) as record:
+            record["items"] = sum(len(chain(individual)) for individual in individuals)
+
+    with stage(stages, "graph") as record:
+        graph = gedcom.graph()
+        record["items"] = len(graph)
+    sample = list(range(0, len(graph), max(1, len(graph) // 1000)))
+    with stage(stages, "graph:ancestors") as record:
+        record["items"] = sum(len(graph.ancestors([person])) for person in sample)
+    with stage(stages, "graph:descendants") as record:
+        record["items"] = sum(len(graph.descendants([person], 4)) for person in sample)
+    with stage(stages, "graph:relationship_path") as record:
+        paths = [graph.relationship_path(sample[i], sample[-1 - i]) for i in range(min(100, len(sample)))]
+        record["items"] = sum(len(path) for path in paths if path)
+
+    make_data = load_make_data()
+    args = make_data.make_parser().parse_args(["--note", "--citations"])
+    with stage(stages, "records") as record:
+        remap = make_data.make_remap(gedcom.pointer_dict)
+        for individual in individuals:
+            make_data.process_individual(individual, graph, remap, args, {})
+        record["items"] = len(individuals)
+
+    if not skip_export:
+        stages.extend(run_export(gedcom_path, size, export_args))
+    return stages
+
+def generator_version():
+    with open(generator_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:8]
+
+def synthetic_gedcom(work_dir, size, seed):
+    """
+    Return the path of a synthetic gedcom with size individuals, generating it
+    if it isn't in work_dir yet. The name includes a hash of the generator, so
+    changing it makes new files.
+    """
+    path = os.path.join(work_dir, "synthetic-%d-%d-%s.ged" % (size, seed, generator_version()))
+    if not os.path.exists(path):
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        subprocess.run([sys.executable, generator_path, "--individuals", str(size), "--seed", str(seed),
+            "--output", temp_path], check=True)
+        os.replace(temp_path, path)
+    return path
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=util_dir, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def combine(runs):
+    """
+    Combine the stage records of repeated runs: the best time of each stage,
+    and the highest memory use.
+    """
+    combined = [dict(record) for record in runs[0]]
+    for run in runs[1:]:
+        for (record, other) in zip(combined, run):
+            for key in ("wall_s", "cpu_s"):
+                record[key] = min(record[key], other[key])
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], other["peak_rss_mb"])
+    return combined
+
+def compare(old, new):
+    """
+    Print how each stage's time and memory changed between two results files.
+    """
+    old_stages = dict(((result["size"], record["stage"]), record)
+        for result in old["results"] for record in result["stages"])
+    print("%10s  %-26s %10s %10s %8s %10s %10s" % ("size", "stage", "old s", "new s", "change", "old MB", "new MB"))
+    for result in new["results"]:
+        for record in result["stages"]:
+            before = old_stages.get((result["size"], record["stage"]))
+            if before is None:
+                continue
+            change = (record["wall_s"] - before["wall_s"]) / before["wall_s"] * 100 if before["wall_s"] else 0.0
+            print("%10d  %-26s %10.3f %10.3f %+7.1f%% %10.1f %10.1f" % (result["size"], record["stage"],
+                before["wall_s"], record["wall_s"], change, before["peak_rss_mb"], record["peak_rss_mb"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gedcom parsing, queries and export on synthetic trees")
+    parser.add_argument("--sizes", help="Comma-separated numbers of individuals", default="1000,10000,100000,1000000")
+    parser.add_argument("--seed", type=int, help="Random seed for the synthetic gedcoms", default=1)
+    parser.add_argument("--repeat", type=int, help="Run each size this many times, keeping the best times", default=1)
+    parser.add_argument("--compact", help="Benchmark the compact storage (and pass --compact to make-data.py)", action="store_true")
+    parser.add_argument("--export-args", help="Extra arguments for make-data.py, e.g. \"--stream --format columnar\"", default="")
+    parser.add_argument("--skip-export", help="Don't run make-data.py", action="store_true")
+    parser.add_argument("--work-dir", help="Directory for the synthetic gedcoms",
+        default=os.path.join(tempfile.gettempdir(), "familyviewer-benchmark"))
+    parser.add_argument("--output", help="Write results to this JSON file (default: standard output)")
+    parser.add_argument("--compare", help="Print changes from the results in this JSON file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    storage = "slots" if args.compact else "dict"
+    export_args = args.export_args.split() + (["--compact"] if args.compact else [])
+
+    if args.worker:
+        # measure one gedcom, in a process of its own
+        (gedcom_path, size) = args.worker.rsplit(":", 1)
+        print(json.dumps(measure(gedcom_path, int(size), storage, export_args, args.skip_export)))
+        return
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        gedcom_path = synthetic_gedcom(args.work_dir, size, args.seed)
+        runs = []
+        for i in range(args.repeat):
+            command = [sys.executable, os.path.abspath(__file__), "--worker", "%s:%d" % (gedcom_path, size)]
+            command += sys.argv[1:]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+        results.append({"size": size, "gedcom_bytes": os.path.getsize(gedcom_path), "stages": combine(runs)})
+        print("Measured %d individuals" % size, file=sys.stderr)
+
+    report = {
+        "version": results_version,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "storage": storage,
+        "export_args": export_args,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
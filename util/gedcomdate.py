@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+Parsing of GEDCOM date values into sortable keys.
+
+The grammar is described in the DATE_VALUE section of the GEDCOM 5.5 spec
+(http://homepages.rootsweb.ancestry.com/~pmcbride/gedcom/55gcch2.htm#DATE_VALUE).
+This understands the standard forms, e.g.
+
+    3 MAR 1980
+    MAR 1980
+    ABT 1850
+    BEF 12 JUN 1901
+    BET 1850 AND 1860
+    FROM 1914 TO 1918
+    INT 1900 (sometime around the turn of the century)
+    1750/51
+
+as well as some common nonstandard ones, such as "Abt. 1850", "circa 1850",
+"1850-1860", full month names, and day-month dates without a year. Anything
+else is handed to dateutil, if it's installed.
+
+Parsed dates are kept in a cache, since the same strings come up again and
+again in a typical tree.
+"""
+
+import re
+import datetime
+import functools
+from collections import namedtuple
+
+# A parsed date value. The qualifier is one of "", "ABT", "CAL", "EST", "BEF",
+# "AFT", "BET", "FROM", "TO", "FROM-TO" or "INT", and dates is a list of one or two
+# (year, month, day) tuples. A missing month or day is 1, as with dateutil's defaults.
+DateValue = namedtuple("DateValue", ["qualifier", "dates"])
+
+# Sort keys for missing dates that should go first or last
+earliest = (float("-inf"), 1, 1)
+latest = (float("inf"), 1, 1)
+
+months = {
+    "JAN": 1, "FEB": 2, "MAR": 3, "APR": 4, "MAY": 5, "JUN": 6,
+    "JUL": 7, "AUG": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DEC": 12,
+    "JANUARY": 1, "FEBRUARY": 2, "MARCH": 3, "APRIL": 4, "JUNE": 6, "JULY": 7,
+    "AUGUST": 8, "SEPT": 9, "SEPTEMBER": 9, "OCTOBER": 10, "NOVEMBER": 11, "DECEMBER": 12,
+}
+
+approximations = {
+    "ABT": "ABT", "ABOUT": "ABT", "CIRCA": "ABT", "CA": "ABT", "C": "ABT",
+    "CAL": "CAL", "EST": "EST",
+    "BEF": "BEF", "BEFORE": "BEF", "AFT": "AFT", "AFTER": "AFT",
+}
+
+calendar_escape = re.compile(r'@#D(GREGORIAN|JULIAN)@')
+year_token = re.compile(r'^(\d{1,4})(?:/(\d{1,2}))?$')
+year_range = re.compile(r'^(\d{4})[- ]\d{4}\b')
+iso_date = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+
+def parse_year(token, short_years=True):
+    """
+    Return the year of a year token, or None. For a dual year like 1750/51
+    (old style/new style), the new style year is returned. With short_years,
+    a year of one or two digits is taken to be the one within 50 years of
+    now, as dateutil does, so "3 MAR 80" is in 1980.
+    """
+    match = year_token.match(token)
+    if not match:
+        return None
+    year = int(match.group(1))
+    if short_years and len(match.group(1)) <= 2 and not match.group(2):
+        this_year = datetime.date.today().year
+        year += this_year // 100 * 100
+        if year >= this_year + 50:
+            year -= 100
+        elif year < this_year - 50:
+            year += 100
+    if match.group(2):
+        alternate = match.group(2)
+        year = int(str(year)[:-len(alternate)] + alternate)
+        if year < int(match.group(1)):
+            year += 10 ** len(alternate)
+    return year
+
+def parse_date(tokens):
+    """
+    Parse the tokens of a single date (no qualifiers) as a (year, month, day)
+    tuple, or return None.
+    """
+    if tokens and tokens[-1] in ("BC", "BCE"):
+        bc = True
+        tokens = tokens[:-1]
+    else:
+        bc = False
+    day = month = 1
+    year = datetime.MINYEAR
+    # a short year BC is taken as it is
+    if len(tokens) == 3:
+        (day, month, year) = (tokens[0], months.get(tokens[1]), parse_year(tokens[2], not bc))
+    elif len(tokens) == 2 and tokens[0] in months:
+        (month, year) = (months[tokens[0]], parse_year(tokens[1], not bc))
+    elif len(tokens) == 2:
+        # nonstandard, but used in the birthday list
+        (day, month) = (tokens[0], months.get(tokens[1]))
+    elif len(tokens) == 1:
+        year = parse_year(tokens[0], not bc)
+    else:
+        return None
+    if isinstance(day, str):
+        day = int(day) if day.isdigit() else None
+    if month is None or year is None or day is None or not 1 <= day <= 31:
+        return None
+    if bc:
+        # There's no year 0, so 1 BC is year 0, 2 BC is -1, etc.
+        year = 1 - year
+    return (year, month, day)
+
+def parse_date_value(value):
+    """
+    Parse a GEDCOM date value, returning a DateValue. Raises ValueError if
+    the date can't be understood.
+    """
+    text = calendar_escape.sub(" ", value).upper()
+    text = re.sub(r'\(.*\)', ' ', text)
+    match = iso_date.match(text.strip())
+    if match:
+        return DateValue("", [(int(match.group(1)), int(match.group(2)), int(match.group(3)))])
+    text = text.replace("B.C.", "BC")
+    tokens = text.replace(".", " ").replace(",", " ").split()
+    if not tokens:
+        raise ValueError("Empty date")
+
+    qualifier = ""
+    if tokens[0] in approximations:
+        qualifier = approximations[tokens[0]]
+        tokens = tokens[1:]
+    elif tokens[0] == "INT":
+        qualifier = "INT"
+        tokens = tokens[1:]
+    elif tokens[0] == "BET" and "AND" in tokens:
+        split = tokens.index("AND")
+        dates = [parse_date(tokens[1:split]), parse_date(tokens[split+1:])]
+        if None not in dates:
+            return DateValue("BET", dates)
+        raise ValueError("Can't parse date range %s" % value)
+    elif tokens[0] == "FROM":
+        if "TO" in tokens:
+            split = tokens.index("TO")
+            dates = [parse_date(tokens[1:split]), parse_date(tokens[split+1:])]
+            qualifier = "FROM-TO"
+        else:
+            dates = [parse_date(tokens[1:])]
+            qualifier = "FROM"
+        if None not in dates:
+            return DateValue(qualifier, dates)
+        raise ValueError("Can't parse date period %s" % value)
+    elif tokens[0] == "TO":
+        qualifier = "TO"
+        tokens = tokens[1:]
+
+    # 1850-1860 means sometime in that range, so take the start
+    match = year_range.match(" ".join(tokens))
+    if match:
+        tokens = [match.group(1)]
+    date = parse_date(tokens)
+    if date is None:
+        date = fallback_parse(value)
+    return DateValue(qualifier, [date])
+
+def fallback_parse(value):
+    """
+    Parse a date that isn't in GEDCOM format using dateutil, if it's available.
+    """
+    try:
+        from dateutil import parser
+    except ImportError:
+        raise ValueError("Can't parse date %s" % value)
+    try:
+        date = parser.parse(value, default=datetime.datetime.min)
+    except (ValueError, OverflowError) as e:
+        raise ValueError(str(e))
+    return (date.year, date.month, date.day)
+
+@functools.lru_cache(maxsize=None)
+def date_key(value):
+    """
+    Return a (year, month, day) tuple for sorting by the given GEDCOM date
+    value. For ranges and periods, this is the starting date. Raises
+    ValueError if the date can't be understood.
+    """
+    return parse_date_value(value).dates[0]
@@ -10,6 +10,18 @@ https://github.com/madprime/python-gedcom which was in turn based on one from Da
 """
 
 import re
+import io
+import os
+import gc
+import sys
+import mmap
+import codecs
+import pickle
+import hashlib
+import unicodedata
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
 
 __author__ = "Jeff Epstein"
 __copyright__ = "Copyright 2016, Jeff Epstein"
@@ -30,6 +42,10 @@ class Gedcom(object):
 
     g=Gedcom('mytree.ged')
 
+    Pass storage="slots" to keep the tree as compact Node objects rather than dicts,
+    and cache_dir to reuse a snapshot of the parsed tree if the file hasn't changed.
+    Instead of a file name, you can pass a file object or the file's contents as bytes.
+
     Get all names for everyone with a given name
         g.all().tag('INDI').attr_equal('NAME','Jeffrey Elias /Epstein/').get_attr('NAME')
     Get mother(s) of same
@@ -51,18 +67,59 @@ class Gedcom(object):
     Get source transcriptions paired with titles
         g.all().tag('INDI').attr_equal('NAME','Morris /Epstein/').first().all().sub('SOUR').foreach_tuple(lambda g:g.deref_value().get_attr('TITL'), lambda g:g.sub('DATA').get_attr('TEXT'), lambda g:g.sub('DATA').require_sub_attr('TEXT','CONC').sub('TEXT').get_attr('CONC'))
     """
-    def __init__(self, filename):
-        (self.pointer_dict, self.toplevel) = parse(filename)
+    def __init__(self, filename, encoding=None, storage="dict", cache_dir=None):
+        parsed = None
+        if not isinstance(filename, (str, os.PathLike)):
+            cache_dir = None
+        if cache_dir is not None:
+            parsed = load_snapshot(filename, cache_dir, encoding, storage)
+        if parsed is None:
+            parsed = parse(filename, encoding, storage_types[storage])
+            if cache_dir is not None:
+                save_snapshot(filename, cache_dir, parsed, encoding, storage)
+        (self.pointer_dict, self.toplevel) = parsed
     def all(self):
-        return Selector(self.pointer_dict,self.toplevel['children'])
+        return Selector(self.pointer_dict,self.toplevel['children'],self.toplevel)
+    def graph(self):
+        return FamilyGraph(self.toplevel['children'])
+
+class StreamingGedcom(object):
+    """
+    Like Gedcom, but reads the file one level-0 object at a time instead of
+    holding it all in memory. Queries start from records() rather than all(),
+    and pointers are dereferenced lazily through a RecordIndex, so forward
+    references work as expected:
+
+    g=StreamingGedcom('mytree.ged')
+    for indi in g.records('INDI'):
+        print(indi.get_attr('NAME'), indi.deref('FAMC').deref('HUSB').get_attr('NAME'))
+    """
+    def __init__(self, filename, encoding=None, storage="dict"):
+        self.filename = filename
+        self.encoding = encoding
+        self.node = storage_types[storage]
+        self.pointer_dict = RecordIndex(filename, encoding, node=self.node)
+    def records(self, tag=None):
+        for record in iter_records(self.filename, self.encoding, self.node):
+            if tag is None or record['tag'] == tag:
+                yield Selector(self.pointer_dict, [record])
+    def graph(self):
+        return FamilyGraph(iter_records(self.filename, self.encoding, self.node))
+    def close(self):
+        self.pointer_dict.close()
 
 class Selector(object):
     """
-    A helper class for managing subsets of GEDCOM data.
+    A helper class for managing subsets of GEDCOM data. If recs are
+    all the children of a single object, that object may be given as
+    parent, letting tag() use its index rather than scanning them.
     """
-    def __init__(self, ps, recs):
+    __slots__ = ('ps', 'recs', 'parent')
+
+    def __init__(self, ps, recs, parent=None):
         self.recs = recs
         self.ps = ps
+        self.parent = parent
 
     def value(self):
         return [child['value'] for child in self.recs]
@@ -81,7 +138,8 @@ class Selector(object):
         return [[subs['tag'], subs['value']] for child in self.recs if 'children' in child for subs in child['children']]
 
     def deref(self, name):
-        return Selector(self.ps,[self.ps[subs['value']] for child in self.recs if 'children' in child for subs in child['children'] if subs['tag']==name])
+        return Selector(self.ps,[self.ps[subs['value']] for child in self.recs if 'children' in child
+            for subs in (indexed(child, name) if len(child['children']) >= index_threshold else child['children']) if subs['tag']==name])
 
     def first(self):
         return Selector(self.ps,[self.recs[0]] if self.recs else [])
@@ -99,29 +157,36 @@ class Selector(object):
         return Selector(self.ps, [{'value':i} for i in list(set([child['value'] for child in self.recs]))])
 
     def foreach_tuple(self, *args):
-        return [[arg(Selector(self.ps,[child])) for arg in args] for child in self.recs]
+        return [[arg(each) for arg in args] for each in self.foreach()]
 
     def attr_cond(self, name, fn):
-        return Selector(self.ps,[child for child in self.recs for subs in child['children'] if subs['tag']==name and fn(subs['value'])])
+        return Selector(self.ps,[child for child in self.recs if 'children' in child
+            for subs in (indexed(child, name) if len(child['children']) >= index_threshold else child['children']) if subs['tag']==name and fn(subs['value'])])
 
     def attr_equal(self,name, *values):
-        return Selector(self.ps,[child for child in self.recs for subs in child['children'] if subs['tag']==name and subs['value'] in values])
+        return Selector(self.ps,[child for child in self.recs if 'children' in child
+            for subs in (indexed(child, name) if len(child['children']) >= index_threshold else child['children']) if subs['tag']==name and subs['value'] in values])
 
     def attr_exclude(self,name, *values):
-        return Selector(self.ps,[child for child in self.recs for subs in child['children'] if subs['tag']==name and subs['value'] not in values])
+        return Selector(self.ps,[child for child in self.recs if 'children' in child
+            for subs in (indexed(child, name) if len(child['children']) >= index_threshold else child['children']) if subs['tag']==name and subs['value'] not in values])
 
     def require_sub_attr(self,first,second):
-        return Selector(self.ps,[child for child in self.recs if 'children' in child for sub in child['children'] if sub['tag']==first
-            and 'children' in sub and [t for t in sub['children'] if t['tag']==second]])        
+        return Selector(self.ps,[child for child in self.recs if 'children' in child
+            for sub in (indexed(child, first) if len(child['children']) >= index_threshold else child['children']) if sub['tag']==first
+            and 'children' in sub and [t for t in sub['children'] if t['tag']==second]])
 
     def require_sub(self):
         return Selector(self.ps,[child for child in self.recs if 'children' in child])
 
     def get_attr(self, *names):
-        return [subs['value'] for child in self.recs for subs in child.get('children',[]) if subs['tag'] in names]
+        return [subs['value'] for child in self.recs if 'children' in child
+            for subs in (children_with_tags(child, names) if len(child['children']) >= index_threshold else child['children'])
+            if subs['tag'] in names]
 
     def sub(self, name):
-        return Selector(self.ps,[sub for child in self.recs if 'children' in child for sub in child['children'] if sub['tag']==name])
+        return Selector(self.ps,[sub for child in self.recs if 'children' in child
+            for sub in (indexed(child, name) if len(child['children']) >= index_threshold else child['children']) if sub['tag']==name])
 
     def all(self):
         return Selector(self.ps,[sub for child in self.recs if 'children' in child for sub in child['children'] ])
@@ -130,56 +195,827 @@ class Selector(object):
         return Selector(self.ps,[sub for child in self.recs if 'children' in child for sub in child['children'] if fn(sub['tag'])])
 
     def tag(self,t):
+        if self.parent is not None:
+            return Selector(self.ps,list(tag_index(self.parent).get(t, ())))
         return Selector(self.ps,[child for child in self.recs if child['tag'] == t])
 
-def parse(filepath):
+class FamilyGraph(object):
+    """
+    The parent, child and spouse relationships between all individuals, built
+    in one pass over the INDI and FAM records. Individuals are numbered in file
+    order: pointers maps numbers to pointers, and index maps pointers to numbers.
+    Relationships are kept in adjacency arrays, so that they can be followed in
+    bulk without dereferencing any records:
+
+    graph=g.graph()
+    me=graph.index['@I1@']
+    Get pointers of grandparents and great-grandparents
+        [graph.pointers[i] for (i, generation) in graph.ancestors([me], 3).items() if generation >= 2]
+    Get the chain of relationships between two people
+        graph.relationship_path(me, graph.index['@I42@'])
+
+    Parents come from an individual's FAMC families and children from their FAMS
+    families, in the order they're listed in the individual's record; families
+    that list someone who doesn't refer back to them are ignored, as they are by
+    deref. Spouses include both partners and the other parents of their children.
+    """
+    parent_tags = ("HUSB", "WIFE", "SPOU", "FATH", "MOTH")
+    relations = ("parent", "child", "spouse")
+
+    def __init__(self, records):
+        self.pointers = []
+        self.index = {}
+        famc = []
+        fams = []
+        family_parents = {}
+        family_children = {}
+        for record in records:
+            if record['tag'] == 'INDI':
+                self.index[record['pointer']] = len(self.pointers)
+                self.pointers.append(record['pointer'])
+                subs = record.get('children', ())
+                famc.append([sub['value'] for sub in subs if sub['tag'] == 'FAMC'])
+                fams.append([sub['value'] for sub in subs if sub['tag'] == 'FAMS'])
+            elif record['tag'] == 'FAM':
+                subs = record.get('children', ())
+                family_parents[record['pointer']] = [sub['value'] for sub in subs if sub['tag'] in self.parent_tags]
+                family_children[record['pointer']] = [sub['value'] for sub in subs if sub['tag'] == 'CHIL']
+
+        def people(families, members):
+            return [self.index[pointer] for family in families
+                for pointer in members.get(family, ()) if pointer in self.index]
+        parents = [people(families, family_parents) for families in famc]
+        children = [people(families, family_children) for families in fams]
+        spouses = []
+        for (person, families) in enumerate(fams):
+            coparents = people(families, family_parents) + [parent for child in children[person] for parent in parents[child]]
+            spouses.append([spouse for spouse in dict.fromkeys(coparents) if spouse != person])
+
+        self.adjacency = {}
+        for (relation, lists) in zip(self.relations, (parents, children, spouses)):
+            offsets = array('l', [0])
+            targets = array('l')
+            for lst in lists:
+                targets.extend(lst)
+                offsets.append(len(targets))
+            self.adjacency[relation] = (offsets, targets)
+
+    def __len__(self):
+        return len(self.pointers)
+
+    def related(self, person, relation):
+        """
+        Return the numbers of the people with the given relation ("parent",
+        "child" or "spouse") to the person with the given number.
+        """
+        (offsets, targets) = self.adjacency[relation]
+        return targets[offsets[person]:offsets[person + 1]].tolist()
+
+    def parents(self, person):
+        return self.related(person, "parent")
+
+    def children(self, person):
+        return self.related(person, "child")
+
+    def spouses(self, person):
+        return self.related(person, "spouse")
+
+    def walk(self, people, relation, depth=None):
+        """
+        Follow the given relation from each of people, breadth first, up to depth
+        steps away (or as far as it goes). Returns a dict, in the order people were
+        reached, mapping each of them to the number of steps it took. The starting
+        people are included, at 0.
+        """
+        (offsets, targets) = self.adjacency[relation]
+        found = dict.fromkeys(people, 0)
+        frontier = list(found)
+        steps = 0
+        while frontier and (depth is None or steps < depth):
+            steps += 1
+            reached = []
+            for person in frontier:
+                for other in targets[offsets[person]:offsets[person + 1]]:
+                    if other not in found:
+                        found[other] = steps
+                        reached.append(other)
+            frontier = reached
+        return found
+
+    def ancestors(self, people, depth=None):
+        return self.walk(people, "parent", depth)
+
+    def descendants(self, people, depth=None):
+        return self.walk(people, "child", depth)
+
+    def relationship_path(self, start, end):
+        """
+        Return the shortest chain of relationships leading from one person to
+        another, as a list of (person, relation) pairs, where relation is how
+        person is related to the one before. The list begins with (start, None).
+        Returns None if the two aren't connected.
+        """
+        previous = {start: None}
+        frontier = [start]
+        while frontier and end not in previous:
+            reached = []
+            for person in frontier:
+                for relation in self.relations:
+                    (offsets, targets) = self.adjacency[relation]
+                    for other in targets[offsets[person]:offsets[person + 1]]:
+                        if other not in previous:
+                            previous[other] = (person, relation)
+                            reached.append(other)
+            frontier = reached
+        if end not in previous:
+            return None
+        path = []
+        person = end
+        while previous[person] is not None:
+            (before, relation) = previous[person]
+            path.append((person, relation))
+            person = before
+        path.append((start, None))
+        path.reverse()
+        return path
+
+# Records with fewer children than this are scanned rather than indexed,
+# since an index wouldn't make lookups any faster. Selector methods check
+# this inline, because a function call per record costs more than a scan.
+index_threshold = 16
+
+def tag_index(record):
+    """
+    Return a dict mapping each tag to the list of the record's children with
+    that tag, in order. The index is built the first time it's needed and
+    stored in the record, so it must only be used on completely read records
+    that have children.
+    """
+    index = record.get('index')
+    if index is None:
+        index = {}
+        for sub in record['children']:
+            index.setdefault(sub['tag'], []).append(sub)
+        record['index'] = index
+    return index
+
+def children_with_tags(record, tags):
+    """
+    Return the record's children that have any of the given tags, in document order.
+    """
+    index = tag_index(record)
+    found = [index[t] for t in tags if t in index]
+    if len(found) == 1:
+        return found[0]
+    if not found:
+        return ()
+    return [sub for sub in record['children'] if sub['tag'] in tags]
+
+def indexed(record, tag):
+    """
+    Return the record's children with the given tag.
+    """
+    return tag_index(record).get(tag, ())
+
+# This regexp borrowed (stolen) from https://github.com/madprime/python-gedcom
+# by Madeleine Ball (mpball@gmail.com)
+gedcom_line = re.compile(
+        '^(0|[1-9]+[0-9]*) ' +
+        '(@[^@]+@ |)' +
+        '([A-Za-z0-9_]+)' +
+        '( [^\n\r]*|)' +
+        '(\r|\n)')
+
+def parse_lines(lines):
+    """
+    Tokenize an iterable of GEDCOM lines. Yields a tuple of
+    (line number, level, pointer, tag, value) for each line.
+    """
+    line_num = 1
+    for line in lines:
+        ret = gedcom_line.match(line)
+        if ret:
+            line_parts = ret.groups()
+        else:
+            raise ValueError("Bad gedcom parse at line %s" % line_num)
+
+        yield (line_num, int(line_parts[0]), line_parts[1].rstrip(' '),
+            line_parts[2], line_parts[3].lstrip(' '))
+        line_num += 1
+
+# ANSEL (ANSI Z39.47), the GEDCOM 5.5 default character set, is ASCII plus
+# these characters, and combining diacritics that come before the letter
+# they go with, rather than after it as in Unicode.
+# See https://www.loc.gov/marc/specifications/specchareacc/ExtendedLatin.html
+ansel_characters = {
+    0x88: "", 0x89: "", 0x8D: "\u200D", 0x8E: "\u200C", 0xA1: "\u0141", 0xA2: "\u00D8",
+    0xA3: "\u0110", 0xA4: "\u00DE", 0xA5: "\u00C6", 0xA6: "\u0152", 0xA7: "\u02B9", 0xA8: "\u00B7",
+    0xA9: "\u266D", 0xAA: "\u00AE", 0xAB: "\u00B1", 0xAC: "\u01A0", 0xAD: "\u01AF", 0xAE: "\u02BC",
+    0xB0: "\u02BB", 0xB1: "\u0142", 0xB2: "\u00F8", 0xB3: "\u0111", 0xB4: "\u00FE", 0xB5: "\u00E6",
+    0xB6: "\u0153", 0xB7: "\u02BA", 0xB8: "\u0131", 0xB9: "\u00A3", 0xBA: "\u00F0", 0xBC: "\u01A1",
+    0xBD: "\u01B0", 0xBE: "\u25A1", 0xBF: "\u25A0", 0xC0: "\u00B0", 0xC1: "\u2113", 0xC2: "\u2117",
+    0xC3: "\u00A9", 0xC4: "\u266F", 0xC5: "\u00BF", 0xC6: "\u00A1", 0xC7: "\u00DF", 0xC8: "\u20AC",
+    0xCF: "\u00DF",
+}
+ansel_combining = {
+    0xE0: "\u0309", 0xE1: "\u0300", 0xE2: "\u0301", 0xE3: "\u0302", 0xE4: "\u0303", 0xE5: "\u0304",
+    0xE6: "\u0306", 0xE7: "\u0307", 0xE8: "\u0308", 0xE9: "\u030C", 0xEA: "\u030A", 0xEB: "\uFE20",
+    0xEC: "\uFE21", 0xED: "\u0315", 0xEE: "\u030B", 0xEF: "\u0310", 0xF0: "\u0327", 0xF1: "\u0328",
+    0xF2: "\u0323", 0xF3: "\u0324", 0xF4: "\u0325", 0xF5: "\u0333", 0xF6: "\u0332", 0xF7: "\u0326",
+    0xF8: "\u031C", 0xF9: "\u032E", 0xFA: "\uFE22", 0xFB: "\uFE23", 0xFE: "\u0313",
+}
+
+def ansel_decode(data, errors='strict'):
+    """
+    Decode ANSEL bytes, codec style: returns the text (in NFC form) and the
+    number of bytes used.
+    """
+    data = bytes(data)
+    if data.isascii():
+        return (data.decode('ascii'), len(data))
+    chars = []
+    marks = []
+    for (i, byte) in enumerate(data):
+        if byte in ansel_combining:
+            marks.append(ansel_combining[byte])
+            continue
+        if byte < 0x80:
+            char = chr(byte)
+        elif byte in ansel_characters:
+            char = ansel_characters[byte]
+        elif errors == 'strict':
+            raise UnicodeDecodeError('ansel', data, i, i + 1, 'invalid ANSEL byte')
+        elif errors == 'ignore':
+            continue
+        else:
+            char = "\ufffd"
+        chars.append(char)
+        chars.extend(marks)
+        marks = []
+    chars.extend(marks)
+    return (unicodedata.normalize('NFC', "".join(chars)), len(data))
+
+def ansel_encode(text, errors='strict'):
+    # Only reading ANSEL is supported, so this only handles ASCII
+    return (text.encode('ascii', errors), len(text))
+
+class AnselIncrementalDecoder(codecs.IncrementalDecoder):
+    """
+    Decodes ANSEL in pieces, holding back any diacritics at the end of a piece
+    until the letter they go with arrives.
+    """
+    def __init__(self, errors='strict'):
+        codecs.IncrementalDecoder.__init__(self, errors)
+        self.pending = b''
+
+    def decode(self, data, final=False):
+        data = self.pending + bytes(data)
+        end = len(data)
+        while not final and end > 0 and data[end - 1] in ansel_combining:
+            end -= 1
+        self.pending = data[end:]
+        return ansel_decode(data[:end], self.errors)[0]
+
+    def reset(self):
+        self.pending = b''
+
+    def getstate(self):
+        return (self.pending, 0)
+
+    def setstate(self, state):
+        self.pending = state[0]
+
+ansel_codec = codecs.CodecInfo(name='ansel', encode=ansel_encode, decode=ansel_decode,
+    incrementaldecoder=AnselIncrementalDecoder)
+
+codecs.register(lambda name: ansel_codec if name == 'ansel' else None)
+
+# Python codecs for the values of the CHAR tag in a GEDCOM header
+char_encodings = {
+    "ANSEL": "ansel", "UTF-8": "utf-8", "UTF8": "utf-8", "UNICODE": "utf-16",
+    "ASCII": "ascii", "ANSI": "cp1252", "IBM WINDOWS": "cp1252", "WINDOWS": "cp1252",
+    "IBMPC": "cp437", "IBM DOS": "cp437", "MACINTOSH": "mac_roman",
+    "LATIN1": "latin-1", "ISO-8859-1": "latin-1", "ISO8859-1": "latin-1",
+}
+char_header = re.compile(rb'(?m)^\s*1 +CHAR +([^\r\n]+)')
+
+def detect_encoding(head):
+    """
+    Return the name of the codec for a GEDCOM file, given its first few
+    kilobytes: from its byte order mark if it has one, or else the CHAR tag
+    in its header. Files with neither are taken to be UTF-8.
+    """
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    # UTF-16 without a byte order mark, starting with "0 HEAD"
+    if head.startswith(b'0\x00'):
+        return 'utf-16-le'
+    if head.startswith(b'\x000'):
+        return 'utf-16-be'
+    end = head.find(b'\n0', 1)
+    match = char_header.search(head, 0, end if end >= 0 else len(head))
+    if match is None:
+        return 'utf-8'
+    name = match.group(1).strip().decode('ascii', 'replace').upper()
+    encoding = char_encodings.get(name, name.lower())
+    if encoding == 'utf-16':
+        # It says UNICODE, but it isn't UTF-16, or it'd have been caught above
+        return 'utf-8'
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return 'utf-8'
+
+def ascii_compatible(encoding):
+    """
+    Whether the structure of lines (levels, tags, pointers) can be read from
+    the raw bytes of a file in this encoding, as with UTF-8 or ANSEL but not UTF-16.
+    """
+    return "0 @I1@ INDI\n".encode(encoding).endswith(b"0 @I1@ INDI\n")
+
+def dict_node(tag, value, pointer):
+    """
+    Create a GEDCOM object as a plain dict. This is the default representation.
+    """
+    element = {"tag": tag, "value": value}
+    if pointer:
+        element["pointer"] = pointer
+    return element
+
+class Node(object):
+    """
+    A compact alternative to the dicts created by dict_node. Attributes are
+    stored in slots and tag names are interned, which takes a fraction of the
+    memory of a dict per line. Nodes support the subset of the dict interface
+    used by Selector, so queries work the same on either representation.
+    """
+    __slots__ = ('tag', 'value', 'pointer', 'children', 'index')
+
+    # short values (dates, places, pointers, sexes) repeat a lot, so they
+    # are interned as well; long values are usually unique notes and texts
+    intern_limit = 40
+
+    def __init__(self, tag, value, pointer):
+        self.tag = sys.intern(tag)
+        self.value = sys.intern(value) if len(value) <= Node.intern_limit else value
+        self.pointer = pointer or None
+        self.children = None
+        self.index = None
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def setdefault(self, key, default=None):
+        value = getattr(self, key, None)
+        if value is None:
+            setattr(self, key, default)
+            return default
+        return value
+
+    def __repr__(self):
+        return "Node(%r, %r, %r)" % (self.tag, self.value, self.pointer)
+
+    def __reduce__(self):
+        # Much faster to pickle than the default for slots, and leaves out the index
+        return (Node, (self.tag, self.value, self.pointer), self.children)
+
+    def __setstate__(self, children):
+        self.children = children
+
+    @staticmethod
+    def lazy(encoding):
+        """
+        Return a kind of Node that's created with the raw bytes of its value,
+        which are only decoded from the given encoding when the value is read.
+        This is used when parsing bytes, so most values are never decoded.
+        """
+        if encoding not in lazy_node_types:
+            lazy_node_types[encoding] = type("LazyNode", (LazyNode,), {"__slots__": (), "encoding": encoding})
+        return lazy_node_types[encoding]
+
+# The value slot itself, under the value property of LazyNode
+raw_value = Node.value
+
+class LazyNode(Node):
+    """
+    A Node whose value may still be bytes. See Node.lazy, which makes
+    subclasses with an encoding; short values are interned when decoded.
+    """
+    __slots__ = ()
+    encoding = None
+
+    def __init__(self, tag, value, pointer):
+        self.tag = tag
+        raw_value.__set__(self, value)
+        self.pointer = pointer or None
+        self.children = None
+        self.index = None
+
+    @property
+    def value(self):
+        value = raw_value.__get__(self)
+        if value.__class__ is bytes:
+            value = value.decode(self.encoding)
+            if len(value) <= Node.intern_limit:
+                value = sys.intern(value)
+            raw_value.__set__(self, value)
+        return value
+
+    @value.setter
+    def value(self, value):
+        raw_value.__set__(self, value)
+
+lazy_node_types = {}
+
+storage_types = {"dict": dict_node, "slots": Node}
+
+def iter_events(lines, node=dict_node):
+    """
+    Build GEDCOM objects from an iterable of lines, one event at a time.
+    Yields ("start", level, element) when an object is first seen, and
+    ("end", level, element) once all of its children have been read.
+    Elements are created by calling node(tag, value, pointer).
+    Each element is linked into its parent's children, but level-0
+    elements are not linked to anything, so a caller that drops them
+    keeps memory bounded by the largest record.
+    """
+    stack = []
+    for (line_num, level, pointer, tag, value) in parse_lines(lines):
+        if level > len(stack):
+            raise ValueError("Bad gedcom level at line %s" % line_num)
+
+        element = node(tag, value, pointer)
+
+        while len(stack) > level:
+            yield ("end", len(stack) - 1, stack.pop())
+
+        if stack:
+            stack[-1].setdefault("children", []).append(element)
+        stack.append(element)
+        yield ("start", level, element)
+    while stack:
+        yield ("end", len(stack) - 1, stack.pop())
+
+def iter_records(filepath, encoding=None, node=dict_node):
+    """
+    Read a GEDCOM file incrementally, yielding each level-0 object
+    (individual, family, source, etc.) once it has been completely read.
+    Pointers are not resolved; use RecordIndex to look them up.
+    """
+    with open(filepath, 'r', encoding=encoding or file_encoding(filepath)) as gedcom_file:
+        for (event, level, element) in iter_events(gedcom_file, node):
+            if event == "end" and level == 0:
+                yield element
+
+def byte_lines(f, newline):
+    """
+    Yield the lines of a binary file, ending in newline, as iterating over
+    it does for b'\\n'.
+    """
+    pending = b''
+    for block in iter(lambda: f.read(1 << 16), b''):
+        lines = (pending + block).split(newline)
+        pending = lines.pop()
+        for line in lines:
+            yield line + newline
+    if pending:
+        yield pending
+
+def file_encoding(filepath):
+    with open(filepath, 'rb') as f:
+        return detect_encoding(f.read(encoding_head_size))
+
+class RecordIndex(Mapping):
+    """
+    A pointer dictionary that doesn't keep the GEDCOM in memory. A first
+    pass over the file records the offset of each level-0 object with an
+    identifier; objects are then parsed on demand when looked up, and the
+    most recently used ones are kept in a small cache.
+
+    Files in encodings like UTF-16, whose lines can't be found in the raw
+    bytes, are read as text, and the offsets are worked out from the length
+    of each line when encoded again. Files with old Macintosh line endings
+    (CR only) are split into lines at CRs, as parse_bytes does.
+    """
+    def __init__(self, filepath, encoding=None, cache_size=4096, node=dict_node):
+        self.node = node
+        self.encoding = encoding or file_encoding(filepath)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.offsets = {}
+        self.filepath = filepath
+        self.open()
+        if ascii_compatible(self.encoding):
+            self.text_encoding = None
+            head = self.gedcom_file.read(encoding_head_size)
+            self.newline = b'\r' if b'\n' not in head and b'\r' in head else b'\n'
+            self.gedcom_file.seek(0)
+            offset = 0
+            for line in self.file_lines():
+                if line.startswith(b'0 @'):
+                    pointer = line.split(b' ', 2)[1].rstrip(b'\r\n')
+                    self.offsets[pointer.decode(self.encoding)] = offset
+                offset += len(line)
+        else:
+            # The byte order mark, if there is one, is only at the start of the file
+            (self.text_encoding, offset) = (self.encoding, 0)
+            if codecs.lookup(self.encoding).name == 'utf-16':
+                bom = self.gedcom_file.read(2)
+                (self.text_encoding, offset) = {codecs.BOM_UTF16_BE: ('utf-16-be', 2),
+                    codecs.BOM_UTF16_LE: ('utf-16-le', 2)}.get(bom, ('utf-16-le', 0))
+            with open(filepath, 'r', encoding=self.encoding, newline='') as gedcom_text:
+                for line in gedcom_text:
+                    if line.startswith('0 @'):
+                        self.offsets[line.split(' ', 2)[1].rstrip('\r\n')] = offset
+                    offset += len(line.encode(self.text_encoding))
+
+    def open(self):
+        self.gedcom_file = open(self.filepath, 'rb')
+        self.pid = os.getpid()
+
+    def file_lines(self):
+        if self.newline == b'\n':
+            return self.gedcom_file
+        return byte_lines(self.gedcom_file, self.newline)
+
+    def __getitem__(self, pointer):
+        if pointer in self.cache:
+            self.cache.move_to_end(pointer)
+            return self.cache[pointer]
+        if self.pid != os.getpid():
+            # In a forked child, whose file position would be shared with the parent
+            self.open()
+        self.gedcom_file.seek(self.offsets[pointer])
+        def lines():
+            file_lines = iter(self.file_lines())
+            yield next(file_lines).decode(self.encoding)
+            for line in file_lines:
+                if line.startswith(b'0'):
+                    break
+                yield line.decode(self.encoding)
+        def text_lines():
+            reader = codecs.getreader(self.text_encoding)(self.gedcom_file)
+            line = reader.readline()
+            while line:
+                yield line
+                line = reader.readline()
+                if line.startswith('0'):
+                    break
+        for (event, level, element) in iter_events(text_lines() if self.text_encoding else lines(), self.node):
+            if event == "end" and level == 0:
+                record = element
+        self.cache[pointer] = record
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return record
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.gedcom_file.close()
+
+def parse(source, encoding=None, node=dict_node):
     """
     Simply parse the GEDCOM and return its contents as nested Python dicts. Returns
     a tuple: the first object of the tuple is the so-called pointer dictionary, containing
     keys mapping to all GEDCOM objects with a an identifier. The second object of the
     returned tuple is the top-level GEDCOM object, whose children are all objects in the file.
-    """
+    Pass node=Node to get compact objects instead of dicts.
 
-    # This regexp borrowed (stolen) from https://github.com/madprime/python-gedcom
-    # by Madeleine Ball (mpball@gmail.com)
-    gedcom_line = re.compile(
-            '^(0|[1-9]+[0-9]*) ' +
-            '(@[^@]+@ |)' +
-            '([A-Za-z0-9_]+)' +
-            '( [^\n\r]*|)' +
-            '(\r|\n)')
-    line_num = 1
+    The source may be a file name, a file object, or the contents of a file as bytes.
+    Unless an encoding is given, it's found by detect_encoding. Files are memory-mapped
+    and read as bytes, and with node=Node, values are only decoded when they're used.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return parse_bytes(source, encoding, node)
+    if isinstance(source, io.TextIOBase):
+        return parse_text(source, node)
+    if hasattr(source, 'read'):
+        return parse_file(source, encoding, node)
+    with open(source, 'rb') as gedcom_file:
+        return parse_file(gedcom_file, encoding, node)
+
+def parse_file(gedcom_file, encoding=None, node=dict_node):
+    """
+    Parse a binary file object, memory-mapping it if possible.
+    """
+    try:
+        contents = mmap.mmap(gedcom_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        # not a real file, or an empty one
+        return parse_bytes(gedcom_file.read(), encoding, node)
+    with contents:
+        return parse_bytes(contents, encoding, node)
+
+# How much of the start of a file detect_encoding is given
+encoding_head_size = 65536
+
+def parse_bytes(contents, encoding=None, node=dict_node):
+    """
+    Parse the contents of a GEDCOM file, as bytes or a memory map.
+    """
+    head = bytes(contents[:encoding_head_size])
+    encoding = encoding or detect_encoding(head)
+    if not ascii_compatible(encoding):
+        return parse_text(io.StringIO(bytes(contents).decode(encoding), newline=None), node)
+    if b'\n' not in head and b'\r' in head:
+        # old Macintosh line endings
+        reader = io.BytesIO(bytes(contents).replace(b'\r', b'\n'))
+    elif isinstance(contents, mmap.mmap):
+        reader = contents
+    else:
+        reader = io.BytesIO(contents)
+    reader.seek(len(codecs.BOM_UTF8) if head.startswith(codecs.BOM_UTF8) else 0)
+    # Building the tree creates many objects, none of them garbage
+    gc.disable()
+    try:
+        return build_tree(iter(reader.readline, b''), encoding, node)
+    finally:
+        gc.enable()
+
+tag_token = re.compile(rb'[A-Za-z0-9_]+\Z')
+
+def build_tree(lines, encoding, node=dict_node):
+    """
+    Build the (pointer_dict, toplevel) tuple returned by parse from lines of
+    bytes. This does the same as parse_text, but it splits lines itself rather
+    than using gedcom_line, and checks each different tag and level only once.
+    """
+    lazy = hasattr(node, 'lazy')
+    if lazy:
+        node = node.lazy(encoding)
     pointer_dict = {}
-    toplevel = {}
-    stack = [toplevel]
-    with open(filepath, 'rU') as gedcom_file:
-        for line in gedcom_file:
-            ret = gedcom_line.match(line)
-            if ret:
-                line_parts = ret.groups()
-            else:
+    records = []
+    # the elements that are open at each level, and their children lists
+    stack = []
+    children = [records]
+    tags = {}
+    levels = {}
+    shared = {}
+    for (line_num, line) in enumerate(lines, 1):
+        parts = line.rstrip(b'\r\n').split(b' ', 2)
+        level = levels.get(parts[0])
+        if level is None:
+            if not parts[0].isdigit() or (parts[0].startswith(b'0') and parts[0] != b'0') or len(parts) < 2:
                 raise ValueError("Bad gedcom parse at line %s" % line_num)
+            level = levels[parts[0]] = int(parts[0])
+        tag = parts[1]
+        pointer = ''
+        if tag[:1] == b'@':
+            if len(parts) < 3 or len(tag) < 3 or tag.count(b'@') != 2 or tag[-1:] != b'@':
+                raise ValueError("Bad gedcom parse at line %s" % line_num)
+            pointer = tag.decode(encoding)
+            (tag, space, value) = parts[2].partition(b' ')
+        else:
+            value = parts[2] if len(parts) > 2 else b''
+        value = value.lstrip(b' ')
+        if lazy and len(value) <= Node.intern_limit:
+            # like Node's interning of short values
+            value = shared.setdefault(value, value)
+        name = tags.get(tag)
+        if name is None:
+            if not tag_token.match(tag):
+                raise ValueError("Bad gedcom parse at line %s" % line_num)
+            name = tags[tag] = sys.intern(tag.decode('ascii'))
+        element = node(name, value if lazy else value.decode(encoding), pointer)
 
-            level = int(line_parts[0])
-            pointer = line_parts[1].rstrip(' ')
-            tag = line_parts[2]
-            value = line_parts[3].lstrip(' ')
-
-            if level > len(stack) - 1:
+        depth = len(stack)
+        if level != depth:
+            if level > depth:
                 raise ValueError("Bad gedcom level at line %s" % line_num)
+            del stack[level:]
+            del children[level + 1:]
+        siblings = children[level]
+        if siblings is None:
+            siblings = children[level] = []
+            stack[-1]["children"] = siblings
+        siblings.append(element)
+        if pointer:
+            pointer_dict[pointer] = element
+        stack.append(element)
+        children.append(None)
+    return (pointer_dict, {"children": records} if records else {})
+
+def parse_text(lines, node=dict_node):
+    """
+    Parse the lines of a GEDCOM file that have already been decoded.
+    """
+    pointer_dict = {}
+    toplevel = {}
+    for (event, level, element) in iter_events(lines, node):
+        if event == "start":
+            if "pointer" in element:
+                pointer_dict[element["pointer"]] = element
+            if level == 0:
+                toplevel.setdefault("children", []).append(element)
+    return (pointer_dict, toplevel)
 
-            element = {"tag": tag, "value": value}
-            if pointer:
-                element["pointer"] = pointer
-                pointer_dict[pointer] = element
+# Bump this when the parsed representation changes, to invalidate old snapshots
+snapshot_version = 1
 
-            while len(stack)-1 > level:
-                stack.pop()
+def snapshot_path(filepath, cache_dir, encoding=None, storage="dict"):
+    """
+    Return the name of the snapshot file for a GEDCOM parsed with the given options.
+    """
+    key = "%s\0%s\0%s" % (os.path.abspath(filepath), encoding, storage)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".snapshot")
 
-            parent_elem = stack[-1]
-            
-            parent_elem.setdefault("children", []).append(element)
-            stack.append(element)
-            line_num += 1
-    return (pointer_dict, toplevel)
+def file_digest(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
+def load_snapshot(filepath, cache_dir, encoding=None, storage="dict"):
+    """
+    Return the (pointer_dict, toplevel) tuple saved by save_snapshot, or None if
+    there's no snapshot, or it's corrupt, or it's out of date. A snapshot is current
+    if the file's size and modification time match, or failing that, its content hash;
+    in that case the snapshot's modification time is updated, so that the file isn't
+    hashed again next time.
+    The snapshot is a pickle, so cache_dir must not be writable by anyone untrusted.
+    """
+    path = snapshot_path(filepath, cache_dir, encoding, storage)
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header.get("version") != snapshot_version:
+                return None
+            stat = os.stat(filepath)
+            if header["size"] != stat.st_size:
+                return None
+            touched = header["mtime"] != stat.st_mtime_ns
+            if touched and header["digest"] != file_digest(filepath):
+                return None
+            offset = f.tell()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                if touched:
+                    header["mtime"] = stat.st_mtime_ns
+                    refresh_snapshot(path, header, contents, offset)
+                # Unpickling creates a lot of objects, none of them garbage
+                gc.disable()
+                try:
+                    with memoryview(contents) as view:
+                        return pickle.loads(view[offset:])
+                finally:
+                    gc.enable()
+    except (OSError, EOFError, ValueError, KeyError, AttributeError, TypeError,
+            IndexError, pickle.UnpicklingError):
+        return None
+
+def refresh_snapshot(path, header, contents, offset):
+    """
+    Rewrite a snapshot with a new header, copying the pickled tree as it is.
+    It's only a cache, so it doesn't matter if this fails.
+    """
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            with memoryview(contents) as view:
+                f.write(view[offset:])
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def save_snapshot(filepath, cache_dir, parsed, encoding=None, storage="dict"):
+    """
+    Save the result of parse() so that load_snapshot can return it later.
+    It's only a cache, so if it can't be saved (e.g. cache_dir isn't
+    writable, or is full), it's left out.
+    """
+    stat = os.stat(filepath)
+    header = {"version": snapshot_version, "size": stat.st_size,
+        "mtime": stat.st_mtime_ns, "digest": file_digest(filepath)}
+    path = snapshot_path(filepath, cache_dir, encoding, storage)
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(parsed, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -1,10 +1,62 @@
 #!/usr/bin/python3
 import jgedcom
+import gedcomdate
+import pictures
 import json
-from dateutil import parser
 import datetime
 import re
+import os
+import gc
+import base64
+import hashlib
+import gzip
+import heapq
+import shutil
+import multiprocessing
 import argparse
+import unicodedata
+import sys
+import time
+import platform
+import contextlib
+import cProfile
+import pstats
+from collections import deque
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+manifest_version = 1
+
+metrics_version = 1
+
+# Stages of the export that --metrics-out reports on, and --profile can profile
+metrics_stages = ["parse", "load_previous", "graph", "family_order", "records", "build_records",
+    "clean_cites", "sort_chrono", "write_details", "write_citations", "write_structure", "birthdays", "search_index", "narratives", "pictures", "finish"]
+
+# Number of slowest individuals, and of most expensive functions under --profile, in the metrics report
+outlier_count = 20
+profile_limit = 40
+
+# Search index shards with more entries than this are split by a longer prefix
+search_shard_size = 5000
+
+# Number of structure entries sorted in memory at once; more are merged from temporary files
+sort_run_size = 50000
+
+# With more partitions than this, their files are written one at a time, to
+# stay well within the limit on open files
+max_open_writers = 64
+
+pictures_manifest_version = 1
+
+# OBJE media types that are shown with photos rather than documents
+photo_media_types = ("", "photo", "photograph", "picture", "portrait")
 
 def java_hashcode(s):
     # https://gist.github.com/hanleybrand/5224673
@@ -28,14 +80,20 @@ def sort_cites(lst):
     return lst
 
 def uniq(lst):
-    return list(set(lst))
+    # keeps the first occurrence of each item, so the output is the same from run to run
+    return list(dict.fromkeys(lst))
 
-def slow_uniq(lst):
-    res = []
+def frozen(value):
+    if isinstance(value, list):
+        return tuple(frozen(each) for each in value)
+    return value
+
+def uniq_lists(lst):
+    # like uniq, for lists of lists, which have to be made hashable first
+    res = {}
     for each in lst:
-        if each not in res:
-            res.append(each)
-    return res
+        res.setdefault(frozen(each), each)
+    return list(res.values())
 
 def concat_text(rest):
     for [tag, val] in rest:
@@ -47,6 +105,16 @@ def clean_note(n):
     rest = concat_text(n[1])
     return "".join(n[0]+rest)
 
+def citation_id(source, text):
+    """
+    Return the id of a citation in the citation table: a hash of its source's
+    pointer and its text, with whitespace normalized, so that the same
+    citation of the same source gets the same id for everyone who has it,
+    whichever process makes it and whichever run.
+    """
+    key = "%s\0%s" % (source, " ".join(unicodedata.normalize("NFC", text).split()))
+    return base64.urlsafe_b64encode(hashlib.sha1(key.encode('utf-8')).digest()[:9]).decode('ascii')
+
 def shorten_date(val):
     if not val:
         return val
@@ -86,68 +154,49 @@ def clean_cites(cites):
     # TODO: sort citation in order, provide x-ref with Ancestry page ID
     return res
 
-def dtparse(s):
-    return parser.parse(s, default=datetime.datetime.min)
+def name_index_key(x):
+    name = x["name"]
+    parts = name.split(" ")
 
-def sort_name_index(name_index):
-    def sorter(x):
-        name = x["name"]
-        parts = name.split(" ")
+    surnames = []
+    nonsurnames = []
+    insurname = False
+    for part in parts:
+        if part.startswith("/"):
+            insurname = True
 
-        surnames = []
-        nonsurnames = []
-        insurname = False
-        for part in parts:
-            if part.startswith("/"):
-                insurname = True
-
-            if insurname:
-                surnames.append(part.replace("/",""))
-            else:
-                nonsurnames.append(part.replace("/",""))
+        if insurname:
+            surnames.append(part.replace("/",""))
+        else:
+            nonsurnames.append(part.replace("/",""))
 
-            if part.endswith("/") and insurname:
-                insurname = False
+        if part.endswith("/") and insurname:
+            insurname = False
 
-        return surnames + nonsurnames
-
-    name_index.sort(key=sorter)
+    return surnames + nonsurnames
 
 def sort_chrono(lst):
-    def clean(x):
-        if x.startswith("abt ") or x.startswith("ABT "):
-            x=x[4:]
-        if x.startswith("Abt. "):
-            x=x[5:]
-        while True:
-            rem = re.match('^(\d\d\d\d)[- ]\d\d\d\d',x)
-            if rem:
-                x=rem.groups()[0]
-            else:
-                break
-        return x
     def sortkey(x):
         if x[0] == "":
             if x[-1] == "B":
-                return datetime.datetime(datetime.MINYEAR,1,1)
+                return gedcomdate.earliest
             elif x[-1] == "D":
-                return datetime.datetime(datetime.MAXYEAR,1,1)
+                return gedcomdate.latest
             else:
                 raise ValueError("Missing date where expected: %s" % x)
-        return dtparse(clean(x[0]))
+        return gedcomdate.date_key(x[0])
     for n in lst:
         try:
-            v = clean(n[0]).strip()
-            if v != "":
-                dtparse(v)
+            if n[0].strip() != "":
+                gedcomdate.date_key(n[0])
         except Exception as e:
             raise Exception("Can't parse %s as date because %s" %
-                (clean(n[0]),str(e)))
+                (n[0],str(e)))
     lst.sort(key=sortkey)
     return lst
 
 def sort_birthdays(birthdays):
-    birthdays.sort(key=lambda x: dtparse(x[1]))
+    birthdays.sort(key=lambda x: gedcomdate.date_key(x[1]))
 
 def clean_birthday_date(dat):
     v = dat.split()
@@ -177,8 +226,1003 @@ def exclude(val, lst):
         lst.remove(val)
     return lst
 
-def main():
+def make_remap(pointer_dict):
+    """
+    Return a function that maps a list of gedcom pointers to the ids used in
+    the output. Ids are resolved on first use, so that individuals can be
+    processed in a single pass even if they refer to people later in the file.
+    """
+    id_mapping = {}
+    def remap(n):
+        for x in n:
+            if x not in id_mapping:
+                id_mapping[x] = real_id(jgedcom.Selector(pointer_dict, [pointer_dict[x]]))
+        return [id_mapping[x] for x in n]
+    return remap
+
+def build_records(individual, graph, remap, args, metrics=None):
+    """
+    Return an individual's entry in the structure file, their entry in the
+    details file, and their entry in the birthdays file (or None).
+    """
+    (person, birthday) = build_person(individual, graph, remap)
+    return (person, build_detail(individual, remap, args, metrics), birthday)
+
+def build_person(individual, graph, remap):
+    """
+    Return an individual's entry in the structure file, and their entry in
+    the birthdays file (or None).
+    """
+    # subqueries used more than once below are only evaluated once
+    pointer = first(individual.pointer())
+    person_id = first(remap([pointer]))
+    person_number = graph.index[pointer]
+    relatives = lambda numbers: remap([graph.pointers[number] for number in numbers])
+    births = individual.sub('BIRT')
+    deaths = individual.sub('DEAT')
+
+    person = {
+        "id": person_id,
+        "name": (first(individual.get_attr('NAME'))),
+        "sex": first(individual.get_attr('SEX'), "z").lower(),
+        "parents": relatives(graph.parents(person_number)),
+
+        # we take both those listed as spouses, as well as all those listed as coparents, but not spouses
+        # Unexpectedly, Ancestry allows people to share children even if they are  not listed as spouses
+        # In the Gedcom, there were example of a child having two FAMC references: one for the mother
+        # and one for the father. Not sure if that's valid, but in either case we now deal with it:
+        # the graph's spouses include the individual's children's other parents.
+        "spouses": relatives(graph.spouses(person_number)),
+        "children": relatives(graph.children(person_number)),
+        "birth": first(births.foreach_tuple(lambda g: 
+            shorten_date(first(g.get_attr('DATE'), "")),lambda g: shorten_place_name(first(g.get_attr('PLAC'), "")) ),["",""]),
+        "death": first(deaths.foreach_tuple(lambda g: 
+            shorten_date(first(g.get_attr('DATE'), "")),lambda g: shorten_place_name(first(g.get_attr('PLAC'), "")) ), ["",""]),
+    }
+    birthday = [
+        person_id,
+        clean_birthday_date(first(births.sub('DATE').value(), ""))
+    ]
+
+    if birthday[1] and not first(deaths.sub('DATE').value(),""):
+        return (person, birthday)
+    return (person, None)
+
+def build_detail(individual, remap, args, metrics=None):
+    """
+    Return an individual's entry in the details file. The time spent in
+    clean_cites and sort_chrono is counted in metrics, if given.
+    """
+    if metrics is None:
+        metrics = no_metrics
+    pointer = first(individual.pointer())
+    person_id = first(remap([pointer]))
+    families = individual.deref('FAMS')
+    births = individual.sub('BIRT')
+    deaths = individual.sub('DEAT')
+    events = individual.sub('EVEN')
+
+    return {
+        "id": person_id,
+        "names": [name for name in individual.get_attr('NAME')],
+        "note": clean_note(individual.tuple(
+            lambda g: g.get_attr('NOTE'), 
+            lambda g: g.sub('NOTE').collect_child_values())) if args.note else "",
+        "cites": build_cites(individual, args, metrics) if args.citations else [],
+        "events":metrics.call("sort_chrono", sort_chrono,
+            #birth
+            mrk(births.foreach_tuple(lambda g: 
+                first(g.get_attr('DATE'), ""),lambda g: first(g.get_attr('PLAC'), ""))[0:1],"B")+
+
+            #death
+            mrk(deaths.foreach_tuple(lambda g: 
+                first(g.get_attr('DATE'), ""),lambda g: first(g.get_attr('PLAC'), ""))[0:1],"D")+
+
+            #travel
+            mrk(events.attr_equal('TYPE','Arrival').attr_exclude('PLAC','').
+                attr_exclude('DATE','').
+                foreach_tuple(
+                    lambda g:first(g.get_attr('DATE'),""),
+                    lambda g:first(g.get_attr('PLAC'),"")),'A')+
+            mrk(events.attr_equal('TYPE','Departure').attr_exclude('PLAC','').
+                attr_exclude('DATE','').
+                foreach_tuple(
+                    lambda g:first(g.get_attr('DATE'),""),
+                    lambda g:first(g.get_attr('PLAC'),"")),'L')+
+
+            #marriage
+            mrk(families.require_sub_attr('MARR','DATE').foreach_tuple(
+                lambda g:first(g.sub('MARR').get_attr('DATE')),
+                lambda g:first(remap(exclude(pointer,g.get_attr("HUSB","WIFE","SPOU","FATH","MOTH")))),
+                lambda g:first(g.sub('MARR').get_attr('PLAC'),"")),'M')+
+
+            #divorce
+            mrk(families.require_sub_attr('DIV','DATE').foreach_tuple(
+                lambda g:first(g.sub('DIV').get_attr('DATE')),
+                lambda g:first(remap(exclude(pointer,g.get_attr("HUSB","WIFE","SPOU","FATH","MOTH")))),
+                lambda g:first(g.sub('DIV').get_attr('PLAC'),"")),'V')+
+
+            # residences 
+            mrk(individual.sub('RESI').attr_exclude('DATE','').attr_exclude('PLAC','').
+                foreach_tuple(lambda g:first(g.get_attr('DATE')), 
+                lambda g:first(g.get_attr('PLAC'))),'R')
+            ),
+    }
+
+def build_cites(individual, args, metrics):
+    """
+    Return an individual's citations as [title, text] pairs, sorted by title.
+    With --citation-table, they're [title, text, id] triples, and there's
+    one for each distinct id.
+    """
+    sources = individual.all().sub('SOUR')
+    cites = sources.foreach_tuple(
+        lambda g:g.deref_value().get_attr('TITL'), 
+        lambda g:g.sub('DATA').get_attr('TEXT'), 
+        lambda g:g.sub('DATA').sub('TEXT').collect_child_values())
+    if not args.citation_table:
+        return sort_cites(metrics.call("clean_cites", clean_cites, uniq_lists(cites)))
+    table = {}
+    for (source, (title, text)) in zip(sources.value(), metrics.call("clean_cites", clean_cites, cites)):
+        table.setdefault(citation_id(source, text), [title, text])
+    return sort_cites([[title, text, cite_id] for (cite_id, (title, text)) in table.items()])
+
+def picture_links(individual):
+    """
+    Return the pictures linked to an individual by OBJE records, on their own
+    record or on their events and citations, as (files, caption, tag) tuples.
+    A picture with several files has a page for each. The tag is "cen" for
+    census records, "ref" for other documents and anything attached to a
+    citation, and None for photos.
+    """
+    links = []
+    def add(objects, tag):
+        for obje in objects.foreach():
+            pointer = first(obje.value(), "")
+            if pointer in obje.ps:
+                obje = obje.deref_value()
+            files = obje.sub('FILE')
+            caption = first(obje.get_attr('TITL') + files.get_attr('TITL'), "")
+            media_type = first(files.sub('FORM').get_attr('TYPE', 'MEDI') + obje.sub('FORM').get_attr('TYPE', 'MEDI') +
+                obje.get_attr('_TYPE'), "").lower()
+            if tag is None and media_type not in photo_media_types:
+                tag = "cen" if media_type == "census" else "ref"
+            if files.value():
+                links.append((files.value(), caption, tag))
+    add(individual.sub('OBJE'), None)
+    add(individual.sub('SOUR').sub('OBJE'), "ref")
+    add(individual.sub('CENS').sub('OBJE'), "cen")
+    add(individual.sub('CENS').sub('SOUR').sub('OBJE'), "cen")
+    events = individual.sub_cond(lambda tag: tag not in ('OBJE', 'SOUR', 'CENS'))
+    add(events.sub('OBJE'), None)
+    add(events.sub('SOUR').sub('OBJE'), "ref")
+    return links
+
+def record_fingerprint(individual, remap, args):
+    """
+    Hash all of the gedcom data that build_records reads for an individual:
+    their own record, their families, their children's families, their sources
+    (if citations are included), and the output ids of everyone in those families.
+    """
+    digest = hashlib.sha1()
+    def add(rec, level):
+        digest.update(("%d %s %s %s\n" % (level, rec.get('pointer', ''), rec['tag'], rec['value'])).encode('utf-8'))
+        for sub in rec.get('children', []):
+            add(sub, level + 1)
+    families = individual.deref('FAMS').recs + individual.deref('FAMC').recs + \
+        individual.deref('FAMS').deref('CHIL').deref('FAMC').recs
+    for rec in individual.recs + families:
+        add(rec, 0)
+    if args.citations:
+        for source in individual.all().sub('SOUR').value():
+            if source in individual.ps:
+                add(individual.ps[source], 0)
+    pointers = jgedcom.Selector(individual.ps, families).get_attr("HUSB","WIFE","SPOU","FATH","MOTH","CHIL")
+    digest.update("\n".join(remap(pointers)).encode('utf-8'))
+    return digest.hexdigest()
+
+def process_individual(individual, graph, remap, args, old_fingerprints, metrics=None):
+    """
+    Return a tuple of an individual's id, their fingerprint (if the export is
+    incremental), and their records from build_records. The records are None
+    if the fingerprint is in old_fingerprints, meaning the records from the
+    last run can be reused. metrics is passed on to build_records.
+    """
+    fingerprint = None
+    if args.incremental:
+        person_id = first(remap(individual.pointer()))
+        fingerprint = record_fingerprint(individual, remap, args)
+        if old_fingerprints.get(person_id) == fingerprint:
+            return (person_id, fingerprint, None)
+    records = build_records(individual, graph, remap, args, metrics)
+    return (records[0]["id"], fingerprint, records)
+
+# Set in the parent before the worker processes are forked
+worker_context = None
+
+def process_chunk(pointers):
+    """
+    Process some individuals in a worker. Returns their results, and the
+    stages and slowest individuals of the worker's metrics, to be merged
+    into the parent's.
+    """
+    (pointer_dict, graph, remap, args, old_fingerprints, metrics_enabled) = worker_context
+    metrics = Metrics(metrics_enabled)
+    results = list(metrics.timed_results("build_records",
+        (process_individual(jgedcom.Selector(pointer_dict, [pointer_dict[pointer]]), graph, remap, args, old_fingerprints, metrics)
+            for pointer in pointers)))
+    return (results, metrics.stages, metrics.slowest)
+
+def process_parallel(search_set, pointer_dict, graph, remap, args, old_fingerprints, metrics, chunk_size=256):
+    """
+    Like calling process_individual on each individual, but spread over
+    args.jobs worker processes. The workers are forked after the gedcom is
+    parsed, so they share it rather than having it sent to them. Results
+    are yielded in the same order as search_set. The workers time their
+    own work, which is added to metrics.
+    """
+    global worker_context
+    pointers = [first(individual.pointer()) for individual in search_set]
+    chunks = [pointers[i:i + chunk_size] for i in range(0, len(pointers), chunk_size)]
+    worker_context = (pointer_dict, graph, remap, args, old_fingerprints, metrics.enabled)
+    # Keep the garbage collector from touching (and so copying) the parsed gedcom in each worker
+    gc.freeze()
+    with multiprocessing.get_context("fork").Pool(args.jobs) as pool:
+        for (results, stages, slowest) in pool.imap(process_chunk, chunks):
+            metrics.merge(stages, slowest)
+            for result in results:
+                yield result
+
+def family_order(graph, remap):
+    """
+    Return everyone's ids ordered so that relatives are near each other:
+    breadth first through parent, child and spouse links, starting each
+    group of connected people from the first of them in the gedcom.
+    """
+    placed = [False] * len(graph)
+    order = []
+    for start in range(len(graph)):
+        if placed[start]:
+            continue
+        placed[start] = True
+        queue = deque([start])
+        while queue:
+            person = queue.popleft()
+            order.append(person)
+            for relation in graph.relations:
+                for other in graph.related(person, relation):
+                    if not placed[other]:
+                        placed[other] = True
+                        queue.append(other)
+    return remap([graph.pointers[person] for person in order])
+
+def narrative_members(spec, graph, ids, numbers):
+    """
+    Return the people in a narrative, in the order that they're shown, as
+    generateNarrative in render.js would list them from the spec: everyone
+    descended from its roots (or, if its dir is "up", their ancestors), with
+    their indent and the distinct [generation, root] pairs by which they're
+    reached, and then, unless the spec's spouses is false, their spouses. ids and
+    numbers map the graph's numbers to output ids and back. Returns None if
+    the spec's dir isn't valid.
+    """
+    if spec.get("dir") == "down":
+        (step, next_gen) = (1, graph.children)
+    elif spec.get("dir") == "up":
+        (step, next_gen) = (-1, graph.parents)
+    else:
+        return None
+    priority = set(spec.get("priority_siblings", []))
+    spouses = lambda person_id: [ids[number] for number in graph.spouses(numbers[person_id])]
+
+    def next_generation(person_id):
+        # important ones first
+        people = [ids[number] for number in next_gen(numbers[person_id])]
+        return [other for other in reversed(people) if other in priority] + [other for other in people if other not in priority]
+
+    seen = {}
+    adjacent = {} # id -> entries placed after them, because they're their spouses
+    narrative = []
+    def visit(root, person_id, depth):
+        """
+        Add someone reached from root, returning whether it's the first time
+        they're reached in this generation from it, and so whether to go on
+        to the next generation. (Their descendants have the same pairs as the
+        last time, and going on would take exponential time in trees where
+        the same people are reached by many paths.)
+        """
+        if person_id in seen:
+            if [depth, root] in seen[person_id]["gen"]:
+                return False
+            seen[person_id]["gen"].append([depth, root])
+            return True
+        entry = {"id": person_id, "indent": depth, "gen": [[depth, root]]}
+        seen[person_id] = entry
+        placed = False
+        if spec.get("adjacent_spouse"):
+            # next to a spouse who's also in the narrative by descent
+            for spouse in spouses(person_id):
+                if spouse in seen:
+                    entry["indent"] = seen[spouse]["indent"]
+                    placed = True
+                    if not any(other is entry for other in adjacent.setdefault(spouse, [])):
+                        adjacent[spouse].append(entry)
+        if not placed:
+            narrative.append(entry)
+        return True
+
+    for root in spec.get("roots", []):
+        if root not in numbers:
+            print("Narrative %s: no such person %s" % (spec.get("name"), root))
+            continue
+        visit(root, root, 0)
+        # depth first, skipping anyone who's their own ancestor in a broken gedcom
+        path = set([root])
+        stack = [(root, 0, iter(next_generation(root)))]
+        while stack:
+            (person_id, depth, others) = stack[-1]
+            other = next(others, None)
+            if other is None:
+                stack.pop()
+                path.discard(person_id)
+            elif other not in path and visit(root, other, depth + step):
+                path.add(other)
+                stack.append((other, depth + step, iter(next_generation(other))))
+
+    members = []
+    for entry in narrative:
+        members.append(entry)
+        members.extend(adjacent.get(entry["id"], []))
+        if spec.get("spouses") != False:
+            # even if they aren't part of the descent
+            for spouse in spouses(entry["id"]):
+                if spouse not in seen:
+                    seen[spouse] = {"id": spouse, "indent": entry["indent"], "gen": [["spouse", entry["id"]]]}
+                    members.append(seen[spouse])
+    return members
+
+def name_tokens(name):
+    """
+    Split a name into the normalized words that the search index is keyed on:
+    lower case, without accents, and without the slashes around surnames.
+    render.js normalizes search text the same way.
+    """
+    name = re.sub("[\u0300-\u036f]", "", unicodedata.normalize("NFKD", name)).lower()
+    return [token for token in re.split(r"[\s/\-,.()\"']+", name) if token]
+
+def search_index(people):
+    """
+    Given (id, names) pairs for everyone, return
+    a list of (prefix, shard) pairs, where each shard is a list of
+    [token, ids] pairs, sorted by token, for all the name tokens beginning with
+    prefix. Tokens are grouped by their first letter, or first two letters if
+    that makes too big a shard, so that the viewer can fetch only the shards
+    for the words being searched for.
+    """
+    tokens = {}
+    for (person_id, names) in people:
+        for name in names:
+            for token in name_tokens(name):
+                tokens.setdefault(token, {})[person_id] = None
+    groups = {}
+    for token in tokens:
+        groups.setdefault(token[:1], []).append(token)
+    shards = []
+    for (prefix, group) in groups.items():
+        if sum(len(tokens[token]) for token in group) > search_shard_size:
+            subgroups = {}
+            for token in group:
+                subgroups.setdefault(token[:2], []).append(token)
+            shards.extend(subgroups.items())
+        else:
+            shards.append((prefix, group))
+    shards.sort()
+    return [(prefix, [[token, sorted(tokens[token])] for token in sorted(group)]) for (prefix, group) in shards]
+
+def build_pictures(individuals, remap, source_dir, output_dir, thumbnail_size, jobs):
+    """
+    Return the contents of pictures.json for the pictures linked to
+    individuals, and the number of pictures read, making their full size and
+    thumbnail copies in output_dir. The size and modification time of each
+    picture read is kept in a manifest in output_dir, along with its id and
+    dimensions, so that pictures that haven't changed aren't read again,
+    unless the thumbnail size has changed, when all the thumbnails are made
+    again. Copies of pictures that are no longer linked to anyone are removed.
+    """
+    found = pictures.scan_directory(source_dir)
+    people = []
+    missing = set()
+    for individual in individuals:
+        links = []
+        for (files, caption, tag) in picture_links(individual):
+            entries = [pictures.find_picture(found, filename) for filename in files]
+            missing.update(filename for (filename, entry) in zip(files, entries) if entry is None)
+            entries = [entry for entry in entries if entry is not None]
+            if entries:
+                links.append((entries, caption or os.path.splitext(os.path.basename(entries[0][0]))[0], tag))
+        if links:
+            people.append((first(remap(individual.pointer())), links))
+    for filename in sorted(missing):
+        print("Picture not found: %s" % filename)
+
+    manifest_filename = os.path.join(output_dir, "manifest.json")
+    manifest = read_json(manifest_filename, {})
+    if manifest.get("version") != pictures_manifest_version:
+        manifest = {}
+    old_files = manifest.get("files", {})
+    resize = manifest.get("thumbnail_size") != thumbnail_size
+    files = {} # path -> [size, mtime_ns, picture id, "WxH"]
+    jobs_list = []
+    for (path, size, mtime_ns) in sorted(set(entry for (person_id, links) in people for (entries, caption, tag) in links for entry in entries)):
+        old = old_files.get(path)
+        if old and old[:2] == [size, mtime_ns] and not resize and os.path.exists(os.path.join(output_dir, "t_%s.jpg" % old[2])):
+            files[path] = old
+        else:
+            jobs_list.append((os.path.join(source_dir, path), output_dir, thumbnail_size, resize))
+            files[path] = [size, mtime_ns, None, None]
+    if jobs_list:
+        os.makedirs(output_dir, exist_ok=True)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(pool.imap_unordered(pictures.process_picture, jobs_list))
+    else:
+        results = [pictures.process_picture(job) for job in jobs_list]
+    for (source, picid, dim, error) in results:
+        path = os.path.relpath(source, source_dir).replace(os.sep, "/")
+        files[path][2:] = [picid, dim]
+        if error is not None:
+            print("Can't read picture %s: %s" % (source, error))
+
+    picture_table = {}
+    people_table = {}
+    for (person_id, links) in people:
+        for (entries, caption, tag) in links:
+            pages = [files[path][2:] for (path, size, mtime_ns) in entries if files[path][2] is not None]
+            if not pages:
+                continue
+            (picid, dim) = pages[0]
+            if picid not in picture_table:
+                picture_table[picid] = {"caption": caption, "dim": dim, "people": []}
+                if tag is not None:
+                    picture_table[picid]["tag"] = tag
+                if len(pages) > 1:
+                    picture_table[picid]["multipage"] = [page for (page, page_dim) in pages[1:]]
+                    for (page, page_dim) in pages[1:]:
+                        picture_table.setdefault(page, {"caption": caption, "dim": page_dim})
+            picture_table[picid].setdefault("people", [])
+            if person_id not in picture_table[picid]["people"]:
+                picture_table[picid]["people"].append(person_id)
+            if picid not in people_table.setdefault(person_id, []):
+                people_table[person_id].append(picid)
+
+    used = set(picid for (size, mtime_ns, picid, dim) in files.values())
+    for (size, mtime_ns, picid, dim) in old_files.values():
+        if picid is not None and picid not in used:
+            for prefix in ("f_", "t_"):
+                if os.path.exists(os.path.join(output_dir, "%s%s.jpg" % (prefix, picid))):
+                    os.remove(os.path.join(output_dir, "%s%s.jpg" % (prefix, picid)))
+    if files or old_files:
+        os.makedirs(output_dir, exist_ok=True)
+        manifest = {"version": pictures_manifest_version, "thumbnail_size": thumbnail_size, "files": files}
+        write_file(manifest_filename, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    return ({"picture_table": picture_table, "people_table": people_table}, len(jobs_list))
+
+def make_string_table():
+    """
+    Return a list of strings, initially empty, and a function that returns
+    the index of a string in the list, adding it if it's not there yet.
+    """
+    strings = []
+    index = {}
+    def ref(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+    return (strings, ref)
+
+# In the columnar format, a structure file is a dict of these columns, plus
+# an ids table that the id, parents, spouses and children columns refer to,
+# and a strings table for birth and death dates and places. render.js decodes it.
+structure_columns = ["id", "name", "sex", "parents", "spouses", "children", "birth", "death"]
+
+def columnar_person(person, writer):
+    ref = lambda s: writer.ref("ids", s)
+    intern = lambda s: writer.ref("strings", s)
+    return [
+        ref(person["id"]),
+        person["name"],
+        person["sex"],
+        [ref(other) for other in person["parents"]],
+        [ref(other) for other in person["spouses"]],
+        [ref(other) for other in person["children"]],
+        [intern(s) for s in person["birth"]],
+        [intern(s) for s in person["death"]],
+    ]
+
+def decode_structure(columns):
+    ids = columns["ids"]
+    strings = columns["strings"]
+    return [{
+        "id": ids[columns["id"][i]],
+        "name": columns["name"][i],
+        "sex": columns["sex"][i],
+        "parents": [ids[other] for other in columns["parents"][i]],
+        "spouses": [ids[other] for other in columns["spouses"][i]],
+        "children": [ids[other] for other in columns["children"][i]],
+        "birth": [strings[s] for s in columns["birth"][i]],
+        "death": [strings[s] for s in columns["death"][i]],
+        } for i in range(len(columns["id"]))]
+
+# A columnar details file has these columns, and a strings table for the
+# strings in citations and events (places, titles, etc.)
+details_columns = ["id", "names", "note", "cites", "events"]
+
+def columnar_detail(detail, writer):
+    intern = lambda s: writer.ref("strings", s)
+    return [
+        detail["id"],
+        detail["names"],
+        detail["note"],
+        # citations are [title, text] pairs, or ids in the citation table
+        [intern(cite) if isinstance(cite, str) else [intern(s) for s in cite] for cite in detail["cites"]],
+        [[intern(s) for s in event] for event in detail["events"]],
+    ]
+
+def decode_details(columns):
+    strings = columns["strings"]
+    return dict((columns["id"][i], {
+        "id": columns["id"][i],
+        "names": columns["names"][i],
+        "note": columns["note"][i],
+        "cites": [strings[cite] if isinstance(cite, int) else [strings[s] for s in cite] for cite in columns["cites"][i]],
+        "events": [[strings[s] for s in event] for event in columns["events"][i]],
+        }) for i in range(len(columns["id"])))
+
+# A citation table file has these columns, and a table of the sources' titles
+citation_columns = ["id", "title", "text"]
+
+def decode_citations(columns):
+    titles = columns["titles"]
+    return dict((columns["id"][i], [titles[columns["title"][i]], columns["text"][i]])
+        for i in range(len(columns["id"])))
+
+def write_file(filename, contents):
+    """
+    Replace a file with new contents atomically, so that someone reading it
+    (e.g. a web server) never sees a partially written file.
+    """
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temp_filename, "wb") as f:
+        f.write(contents)
+    os.replace(temp_filename, filename)
+
+def write_compressed_files(filename):
+    """
+    Write precompressed copies of a file, for web servers that can send them
+    to browsers that accept them: gzip, and brotli if it's installed.
+    """
+    temp_filename = "%s.gz.%d.tmp" % (filename, os.getpid())
+    with open(filename, "rb") as source, open(temp_filename, "wb") as f:
+        with gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=f, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed)
+    os.replace(temp_filename, filename + ".gz")
+    if brotli is not None:
+        temp_filename = "%s.br.%d.tmp" % (filename, os.getpid())
+        compressor = brotli.Compressor()
+        with open(filename, "rb") as source, open(temp_filename, "wb") as f:
+            for chunk in iter(lambda: source.read(1 << 16), b""):
+                f.write(compressor.process(chunk))
+            f.write(compressor.finish())
+        os.replace(temp_filename, filename + ".br")
+
+def remove_compressed_files(filename):
+    for suffix in (".gz", ".br"):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+class JsonWriter(object):
+    """
+    Writes a JSON file a piece at a time, so that big lists and objects never
+    have to be in memory all at once. Lists and objects are started with
+    begin(), filled with add() (giving a key for items of objects), and
+    finished with end(). The output is the same as json.dumps would give
+    with the same json_style, except that sort_keys doesn't reorder the items
+    added to an object.
+
+    The file is written under a temporary name, and close() replaces the real
+    file with it, unless old_files (a map of file names to hashes of their
+    contents) shows that the file already contains exactly that. close()
+    records the hash in new_files, and returns whether the file was written.
+    With precompress, compressed copies are written next to the file.
+    """
+    def __init__(self, filename, json_style):
+        self.filename = filename
+        self.json_style = json_style
+        self.indent = json_style.get("indent")
+        (self.item_separator, self.key_separator) = json_style.get("separators", (", ", ": "))
+        self.temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        self.file = open(self.temp_filename, "wb")
+        self.digest = hashlib.sha1()
+        # number of items so far, and closing bracket, of each list or object being written
+        self.counts = []
+        self.closers = []
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.digest.update(data)
+        self.file.write(data)
+
+    def newline(self):
+        if self.indent:
+            self.write("\n" + " " * (self.indent * len(self.counts)))
+
+    def start_item(self, key):
+        if self.counts:
+            if self.counts[-1]:
+                self.write(self.item_separator)
+            self.counts[-1] += 1
+            self.newline()
+        if key is not None:
+            self.write(json.dumps(key) + self.key_separator)
+
+    def begin(self, brackets="[]", key=None):
+        self.start_item(key)
+        self.write(brackets[0])
+        self.counts.append(0)
+        self.closers.append(brackets[1])
+        return self
+
+    def add(self, value, key=None):
+        self.start_item(key)
+        text = json.dumps(value, **self.json_style)
+        if self.indent and self.counts:
+            text = text.replace("\n", "\n" + " " * (self.indent * len(self.counts)))
+        self.write(text)
 
+    def end(self):
+        count = self.counts.pop()
+        if count:
+            self.newline()
+        self.write(self.closers.pop())
+
+    def close(self, old_files, new_files, precompress=False):
+        while self.counts:
+            self.end()
+        self.file.close()
+        name = os.path.basename(self.filename)
+        new_files[name] = self.digest.hexdigest()
+        if old_files.get(name) == new_files[name] and os.path.exists(self.filename) and \
+                (not precompress or os.path.exists(self.filename + ".gz")):
+            os.remove(self.temp_filename)
+            return False
+        os.replace(self.temp_filename, self.filename)
+        # never leave compressed copies that don't match the file
+        remove_compressed_files(self.filename)
+        if precompress:
+            write_compressed_files(self.filename)
+        return True
+
+class ColumnWriter(object):
+    """
+    Writes a JSON object of columns (lists with an item per row) a row at a
+    time. Rows are kept in a temporary file, and copied out a column at a
+    time when the writer is closed, followed by the string tables named in
+    tables, which ref() fills in as rows are added. close() is as for
+    JsonWriter.
+    """
+    def __init__(self, filename, columns, tables, json_style):
+        self.filename = filename
+        self.columns = columns
+        self.tables = dict((table, make_string_table()) for table in tables)
+        self.json_style = json_style
+        self.rows_filename = "%s.%d.rows.tmp" % (filename, os.getpid())
+        self.rows = open(self.rows_filename, "w", encoding="utf-8")
+
+    def ref(self, table, s):
+        return self.tables[table][1](s)
+
+    def add(self, row):
+        self.rows.write(json.dumps(row) + "\n")
+
+    def close(self, old_files, new_files, precompress=False):
+        self.rows.close()
+        writer = JsonWriter(self.filename, self.json_style).begin("{}")
+        keys = self.columns + list(self.tables)
+        if self.json_style.get("sort_keys"):
+            keys.sort()
+        for key in keys:
+            if key in self.tables:
+                writer.add(self.tables[key][0], key)
+                continue
+            column = self.columns.index(key)
+            writer.begin("[]", key)
+            with open(self.rows_filename, "r", encoding="utf-8") as rows:
+                for line in rows:
+                    writer.add(json.loads(line)[column])
+            writer.end()
+        os.remove(self.rows_filename)
+        return writer.close(old_files, new_files, precompress)
+
+class ExternalSort(object):
+    """
+    Sorts JSON-serializable items by key without keeping more than run_size
+    of them in memory: every run_size items are sorted and saved to a
+    temporary file, and these runs are merged as the sorted items are read.
+    Like list.sort, the sort is stable.
+    """
+    def __init__(self, key, temp_prefix, run_size=sort_run_size):
+        self.key = key
+        self.temp_prefix = temp_prefix
+        self.run_size = run_size
+        self.batch = []
+        self.runs = []
+
+    def add(self, item):
+        self.batch.append(item)
+        if len(self.batch) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        self.batch.sort(key=self.key)
+        filename = "%s.%d.%d.tmp" % (self.temp_prefix, os.getpid(), len(self.runs))
+        with open(filename, "w", encoding="utf-8") as f:
+            for item in self.batch:
+                f.write(json.dumps(item) + "\n")
+        self.runs.append(filename)
+        self.batch = []
+
+    def sorted(self):
+        if not self.runs:
+            self.batch.sort(key=self.key)
+            for item in self.batch:
+                yield item
+            return
+        if self.batch:
+            self.spill()
+        files = [open(run, "r", encoding="utf-8") for run in self.runs]
+        try:
+            for item in heapq.merge(*[(json.loads(line) for line in f) for f in files], key=self.key):
+                yield item
+        finally:
+            for f in files:
+                f.close()
+            for run in self.runs:
+                os.remove(run)
+
+class PartitionWriters(object):
+    """
+    The writers of a set of partition files, which open_writer(partitionid)
+    opens the first time something is added to that partition, and which
+    add_item(writer, item) adds items to. If there are more than
+    max_open_writers partitions, items are sorted by partition first, so
+    that only one file is open at a time. Either way, each file gets its
+    items in the order they were added. close() closes them all, and returns
+    how many files were written, as for JsonWriter; with write_empty, files
+    are also written for partitions that got nothing.
+    """
+    def __init__(self, partitions, open_writer, add_item, temp_prefix, write_empty=False):
+        self.partitions = partitions
+        self.open_writer = open_writer
+        self.add_item = add_item
+        self.write_empty = write_empty
+        self.writers = {}
+        self.spool = ExternalSort(lambda entry: entry[0], temp_prefix) if partitions > max_open_writers else None
+        self.opened = 0
+
+    def add(self, partitionid, item):
+        if self.spool is not None:
+            self.spool.add([partitionid, item])
+            return
+        if partitionid not in self.writers:
+            self.writers[partitionid] = self.open_writer(partitionid)
+            self.opened += 1
+        self.add_item(self.writers[partitionid], item)
+
+    def close(self, old_files, new_files, precompress=False):
+        written = 0
+        if self.spool is not None:
+            (partitionid, writer) = (None, None)
+            for (item_partitionid, item) in self.spool.sorted():
+                if item_partitionid != partitionid:
+                    if writer is not None:
+                        written += writer.close(old_files, new_files, precompress)
+                    partitionid = item_partitionid
+                    writer = self.writers[partitionid] = self.open_writer(partitionid)
+                    self.opened += 1
+                self.add_item(writer, item)
+            if writer is not None:
+                written += writer.close(old_files, new_files, precompress)
+        else:
+            for writer in self.writers.values():
+                written += writer.close(old_files, new_files, precompress)
+        if self.write_empty:
+            for partitionid in range(self.partitions):
+                if partitionid not in self.writers:
+                    written += self.open_writer(partitionid).close(old_files, new_files, precompress)
+        return written
+
+def remove_temp_files(directory):
+    """
+    Remove the temporary files that this process was writing in directory,
+    when the export fails.
+    """
+    marker = ".%d." % os.getpid()
+    for name in os.listdir(directory):
+        if marker in name and name.endswith(".tmp"):
+            os.remove(os.path.join(directory, name))
+
+def write_json(filename, obj, json_style, old_files, new_files, precompress=False):
+    """
+    Write obj to a JSON file. See JsonWriter for the arguments.
+    """
+    writer = JsonWriter(filename, json_style)
+    writer.add(obj)
+    return writer.close(old_files, new_files, precompress)
+
+def read_json(filename, default=None):
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0, 1)
+
+class Metrics(object):
+    """
+    Wall time, CPU time, peak memory use and item counts for each stage of
+    the export, for --metrics-out. A stage can be entered more than once, and
+    its times add up. The slowest individuals are kept, and one stage can be
+    run under cProfile. When disabled, all of this does nothing.
+    """
+    def __init__(self, enabled, profile_stage=None, outliers=outlier_count):
+        self.enabled = enabled
+        self.stages = {}
+        self.outliers = outliers
+        self.slowest = [] # heap of (wall, cpu, id), fastest first
+        self.profile_stage = profile_stage
+        self.profiler = cProfile.Profile() if profile_stage else None
+        self.start = (time.perf_counter(), time.process_time())
+
+    def record(self, name):
+        if name not in self.stages:
+            self.stages[name] = {"stage": name, "calls": 0, "items": 0, "wall_s": 0.0, "cpu_s": 0.0}
+        return self.stages[name]
+
+    def add(self, name, wall, cpu, items=0):
+        record = self.record(name)
+        record["calls"] += 1
+        record["items"] += items
+        record["wall_s"] += wall
+        record["cpu_s"] += cpu
+        record["peak_rss_mb"] = peak_rss_mb()
+
+    def count(self, name, items):
+        if self.enabled:
+            self.record(name)["items"] += items
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        # stages are listed in the order they start
+        self.record(name)
+        if name == self.profile_stage:
+            self.profiler.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+            if name == self.profile_stage:
+                self.profiler.disable()
+
+    def timed_results(self, name, results):
+        """
+        Yield the results of process_individual, counting the time taken to
+        make each one as the stage called name, and keeping the slowest.
+        """
+        if not self.enabled:
+            for result in results:
+                yield result
+            return
+        profile = name == self.profile_stage
+        self.record(name)
+        results = iter(results)
+        while True:
+            if profile:
+                self.profiler.enable()
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            result = next(results, None)
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if profile:
+                self.profiler.disable()
+            if result is None:
+                break
+            self.add(name, wall, cpu, 1)
+            self.add_individual(wall, cpu, result[0])
+            yield result
+
+    def add_individual(self, wall, cpu, person_id):
+        if len(self.slowest) < self.outliers:
+            heapq.heappush(self.slowest, (wall, cpu, person_id))
+        elif wall > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (wall, cpu, person_id))
+
+    def merge(self, stages, slowest):
+        """
+        Add the stages and slowest individuals of another process's Metrics
+        (i.e. a worker's) to these. Its peak memory use is included in each
+        stage's, but not in the total.
+        """
+        if not self.enabled:
+            return
+        for (name, other) in stages.items():
+            record = self.record(name)
+            for field in ("calls", "items", "wall_s", "cpu_s"):
+                record[field] += other[field]
+            record["peak_rss_mb"] = max(record.get("peak_rss_mb") or 0, other.get("peak_rss_mb") or 0) or None
+        for (wall, cpu, person_id) in slowest:
+            self.add_individual(wall, cpu, person_id)
+
+    def call(self, name, function, *args):
+        """
+        Return function(*args), counting the time spent in it as a stage.
+        """
+        if not self.enabled:
+            return function(*args)
+        with self.stage(name):
+            result = function(*args)
+        self.count(name, 1)
+        return result
+
+    def profile_functions(self, limit=profile_limit):
+        try:
+            stats = pstats.Stats(self.profiler)
+        except TypeError:
+            # the stage never ran
+            return []
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [{"function": "%s:%d(%s)" % function, "calls": calls, "total_s": round(total, 4), "cumulative_s": round(cumulative, 4)}
+            for (function, (primitive_calls, calls, total, cumulative, callers)) in functions[:limit]]
+
+    def report(self, args):
+        for record in self.stages.values():
+            record["wall_s"] = round(record["wall_s"], 4)
+            record["cpu_s"] = round(record["cpu_s"], 4)
+        report = {
+            "version": metrics_version,
+            "gedcom": args.gedcom,
+            "options": vars(args),
+            "python": platform.python_version(),
+            "created_date": datetime.datetime.now().isoformat(),
+            "total": {
+                "wall_s": round(time.perf_counter() - self.start[0], 4),
+                "cpu_s": round(time.process_time() - self.start[1], 4),
+                "peak_rss_mb": peak_rss_mb(),
+            },
+            "stages": list(self.stages.values()),
+            "slowest_individuals": [{"id": person_id, "wall_s": round(wall, 6), "cpu_s": round(cpu, 6)}
+                for (wall, cpu, person_id) in sorted(self.slowest, reverse=True)],
+        }
+        if self.profiler:
+            report["profile"] = {"stage": self.profile_stage, "functions": self.profile_functions()}
+        return report
+
+# For building records without counting anything
+no_metrics = Metrics(False)
+
+def make_parser():
     parser = argparse.ArgumentParser(description="Generate familyviewer2 data files from a gedcom")
     parser.add_argument("--gedcom", help="Source gedcom file", default="../../genealogy/Family Tree.ged")
     parser.add_argument("--citations", help="Include citation transcriptions", action="store_true")
@@ -186,152 +1230,322 @@ def main():
     parser.add_argument("--pretty", help="Pretty print output", action="store_true")
     parser.add_argument("--name", help="Get just one person")
     parser.add_argument("--partition-details", type=int, help="Optionally split the details file into several smaller files", default=1)
-    args = parser.parse_args()
+    parser.add_argument("--partition-structure", type=int, help="Optionally split the structure file into several smaller files, which are downloaded in parallel", default=1)
+    parser.add_argument("--partition-by", choices=["hash", "family"], help="How to assign people to partitions: by a hash of their id, or keeping families together (which needs an extra partitions.json file)", default="hash")
+    parser.add_argument("--search-index", help="Write an index of names, so the viewer can search without scanning every name", action="store_true")
+    parser.add_argument("--format", choices=["json", "columnar"], help="Write the structure and details files as plain JSON objects, or as columns of values with repeated strings stored once, which is several times smaller", default="json")
+    parser.add_argument("--precompress", help="Also write gzip (and, if the brotli module is installed, brotli) compressed copies of the data files, for web servers that can serve them", action="store_true")
+    parser.add_argument("--compact", help="Store the parsed gedcom in compact objects rather than dicts, to save memory", action="store_true")
+    parser.add_argument("--cache-dir", help="Directory for keeping a snapshot of the parsed gedcom, which is reused until the gedcom changes")
+    parser.add_argument("--stream", help="Read the gedcom one record at a time rather than loading it into memory", action="store_true")
+    parser.add_argument("--jobs", type=int, help="Number of worker processes to build individuals' data with", default=1)
+    parser.add_argument("--incremental", help="Only rebuild individuals whose data changed since the last run, and only rewrite files whose contents changed", action="store_true")
+    parser.add_argument("--narratives", help="JSON file of narrative specs and descriptions, in the format of narratives.json; the people in each narrative are worked out and added to narratives.json")
+    parser.add_argument("--citation-table", type=int, help="Store each citation once, in a table split into this many files, which the viewer downloads when a Citations tab is opened, rather than in the details of everyone who has it", default=0)
+    parser.add_argument("--partition-narratives", help="Write the people in each narrative to a file of its own, which is downloaded when the narrative is opened", action="store_true")
+    parser.add_argument("--pictures", help="Directory of the pictures linked to individuals by the gedcom's OBJE records; their copies and thumbnails are written to ../pictures, and their details to pictures.json")
+    parser.add_argument("--thumbnail-size", type=int, help="Width and height that picture thumbnails are shrunk to fit", default=120)
+    parser.add_argument("--metrics-out", help="Write a JSON report of the time, memory use and item count of each stage of the export, and the slowest individuals")
+    parser.add_argument("--profile", choices=metrics_stages, help="Run this stage under cProfile, and add its most expensive functions to the metrics report (or print them, without --metrics-out); build_records, clean_cites and sort_chrono run in the workers with --jobs, and are only profiled with --jobs 1")
+    return parser
+
+def main():
+
+    args = make_parser().parse_args()
+
+    metrics = Metrics(bool(args.metrics_out or args.profile), args.profile)
 
     input_filename=args.gedcom # input GEDCOM file
     json_style = {"sort_keys":True, "indent":2, "separators":(',', ': ')} if args.pretty else {}
     structure_outputfile = "../data/structure.json" # structural and relationship data
+    structure_partition_outputfile = "../data/structure%s.json"
     details_outputfile = "../data/details%s.json" # life event data
     config_outputfile = "../data/config.json"
     birthdays_outputfile = "../data/birthdays.json"
+    manifest_outputfile = "../data/manifest.json" # fingerprints from the last incremental run
+    partitions_outputfile = "../data/partitions.json" # which details file each person is in
+    search_outputfile = "../data/search%s.json" # name search index
+    citations_outputfile = "../data/cites%s.json" # citation table, with --citation-table
+    narratives_outputfile = "../data/narratives.json"
+    narrative_outputfile = "../data/narrative%s.json" # people in each narrative, with --partition-narratives
+    pictures_outputfile = "../data/pictures.json"
+    pictures_outputdir = "../pictures" # full size pictures and thumbnails
+
+    storage = "slots" if args.compact else "dict"
+    with metrics.stage("parse"):
+        if args.stream:
+            gedcom = jgedcom.StreamingGedcom(input_filename, storage=storage)
+            search_set = gedcom.records('INDI')
+        else:
+            gedcom = jgedcom.Gedcom(input_filename, storage=storage, cache_dir=args.cache_dir)
+            search_set = gedcom.all().tag('INDI').foreach()
+    metrics.count("parse", len(gedcom.pointer_dict))
+    # The parsed gedcom is kept until the end, so keep the garbage collector from scanning it again and again
+    gc.freeze()
+    if args.name:
+        search_set = (individual for individual in search_set if individual.attr_equal('NAME',args.name).value())
 
-    gedcom = jgedcom.Gedcom(input_filename)
+    # Individuals from the last run can only be reused if they were made with the same options
+    options = {"citations": args.citations, "note": args.note, "pretty": args.pretty,
+        "name": args.name, "partition_details": args.partition_details, "format": args.format,
+        "citation_table": args.citation_table}
+    manifest = read_json(manifest_outputfile, {}) if args.incremental else {}
+    if manifest.get("version") != manifest_version:
+        manifest = {}
+    old_files = manifest.get("files", {})
+    old_fingerprints = manifest.get("records", {}) if manifest.get("options") == options else {}
+    old_structure = {}
+    old_details = {}
+    old_birthdays = {}
+    old_citations = {}
+    if old_fingerprints:
+        with metrics.stage("load_previous"):
+            for name in old_files:
+                if name.startswith("structure"):
+                    people = read_json(os.path.join(os.path.dirname(structure_outputfile), name), [])
+                    for person in (decode_structure(people) if args.format == "columnar" else people):
+                        old_structure[person["id"]] = person
+                if name.startswith("details"):
+                    partition = read_json(os.path.join(os.path.dirname(details_outputfile), name), {})
+                    old_details.update(decode_details(partition) if args.format == "columnar" else partition)
+                if name.startswith("cites"):
+                    old_citations.update(decode_citations(read_json(os.path.join(os.path.dirname(citations_outputfile), name), {})))
+            for birthday in read_json(birthdays_outputfile, []):
+                old_birthdays[birthday[0]] = birthday
+        metrics.count("load_previous", len(old_structure))
 
-    structure = []
-    details = {}
     birthdays = []
+    names = []
+    fingerprints = {}
     initial_person = None
+    count = 0
+    rebuilt = 0
 
-    id_mapping = {}
-    def remap(n):
-        return [id_mapping[x] for x in n]
+    remap = make_remap(gedcom.pointer_dict)
+    with metrics.stage("graph"):
+        graph = gedcom.graph()
+    metrics.count("graph", len(graph))
+    old_fingerprints = dict((person_id, fingerprint) for (person_id, fingerprint) in old_fingerprints.items()
+        if person_id in old_structure and person_id in old_details and
+            all(cite in old_citations for cite in old_details[person_id]["cites"] if isinstance(cite, str)))
 
-    search_set = gedcom.all().tag('INDI')
-    if args.name:
-        search_set = search_set.attr_equal('NAME',args.name)
-
-    for individual in search_set.foreach():
-        id_mapping[first(individual.pointer())] = real_id(individual)
-
-    for individual in search_set.foreach():
-
-        person = {
-            "id": first(remap(individual.pointer())),
-            "name": (first(individual.get_attr('NAME'))),
-            "sex": first(individual.get_attr('SEX'), "z").lower(),
-            "parents": remap(individual.deref('FAMC').get_attr("HUSB","WIFE","SPOU","FATH","MOTH")),
-
-            # we take both those listed as spouses, as well as all those listed as coparents, but not spouses
-            # Unexpectedly, Ancestry allows people to share children even if they are  not listed as spouses
-            # In the Gedcom, there were example of a child having two FAMC references: one for the mother
-            # and one for the father. Not sure if that's valid, but in either case we now deal with it:
-            # the triple deref below collects the individual's children's parents.
-            "spouses": remap(exclude(first(individual.pointer()), uniq(
-                individual.deref('FAMS').get_attr("HUSB","WIFE","SPOU","FATH","MOTH")+
-                individual.deref('FAMS').deref("CHIL").deref('FAMC').get_attr("HUSB","WIFE","SPOU","FATH","MOTH") ) )),
-            "children": remap(individual.deref('FAMS').get_attr("CHIL")),
-            "birth": first(individual.sub('BIRT').foreach_tuple(lambda g: 
-                shorten_date(first(g.get_attr('DATE'), "")),lambda g: shorten_place_name(first(g.get_attr('PLAC'), "")) ),["",""]),
-            "death": first(individual.sub('DEAT').foreach_tuple(lambda g: 
-                shorten_date(first(g.get_attr('DATE'), "")),lambda g: shorten_place_name(first(g.get_attr('PLAC'), "")) ), ["",""]),
-        }
-        if initial_person is None:
-            initial_person = person['id']
-
-        detail = {
-            "id": first(remap(individual.pointer())),
-            "names": [name for name in individual.get_attr('NAME')],
-            "note": clean_note(individual.tuple(
-                lambda g: g.get_attr('NOTE'), 
-                lambda g: g.sub('NOTE').collect_child_values())) if args.note else "",
-            "cites": sort_cites(clean_cites(slow_uniq(individual.all().sub('SOUR').foreach_tuple( 
-                lambda g:g.deref_value().get_attr('TITL'), 
-                lambda g:g.sub('DATA').get_attr('TEXT'), 
-                lambda g:g.sub('DATA').sub('TEXT').collect_child_values())))) if args.citations else [],
-            "events":sort_chrono(
-                #birth
-                mrk(individual.sub('BIRT').foreach_tuple(lambda g: 
-                    first(g.get_attr('DATE'), ""),lambda g: first(g.get_attr('PLAC'), ""))[0:1],"B")+
-
-                #death
-                mrk(individual.sub('DEAT').foreach_tuple(lambda g: 
-                    first(g.get_attr('DATE'), ""),lambda g: first(g.get_attr('PLAC'), ""))[0:1],"D")+
-
-                #travel
-                mrk(individual.sub('EVEN').attr_equal('TYPE','Arrival').attr_exclude('PLAC','').
-                    attr_exclude('DATE','').
-                    foreach_tuple(
-                        lambda g:first(g.get_attr('DATE'),""),
-                        lambda g:first(g.get_attr('PLAC'),"")),'A')+
-                mrk(individual.sub('EVEN').attr_equal('TYPE','Departure').attr_exclude('PLAC','').
-                    attr_exclude('DATE','').
-                    foreach_tuple(
-                        lambda g:first(g.get_attr('DATE'),""),
-                        lambda g:first(g.get_attr('PLAC'),"")),'L')+
-
-                #marriage
-                mrk(individual.deref('FAMS').require_sub_attr('MARR','DATE').foreach_tuple(
-                    lambda g:first(g.sub('MARR').get_attr('DATE')),
-                    lambda g:first(remap(exclude(first(individual.pointer()),g.get_attr("HUSB","WIFE","SPOU","FATH","MOTH")))),
-                    lambda g:first(g.sub('MARR').get_attr('PLAC'),"")),'M')+
-
-                #divorce
-                mrk(individual.deref('FAMS').require_sub_attr('DIV','DATE').foreach_tuple(
-                    lambda g:first(g.sub('DIV').get_attr('DATE')),
-                    lambda g:first(remap(exclude(first(individual.pointer()),g.get_attr("HUSB","WIFE","SPOU","FATH","MOTH")))),
-                    lambda g:first(g.sub('DIV').get_attr('PLAC'),"")),'V')+
-
-                # residences 
-                mrk(individual.sub('RESI').attr_exclude('DATE','').attr_exclude('PLAC','').
-                    foreach_tuple(lambda g:first(g.get_attr('DATE')), 
-                    lambda g:first(g.get_attr('PLAC'))),'R')
-                ),
-        }
-        birthday = [
-            first(remap(individual.pointer())),
-            clean_birthday_date(first(individual.sub('BIRT').sub('DATE').value(), ""))
-        ]
-
-        if birthday[1] and not first(individual.sub('DEAT').sub('DATE').value(),""):
-            birthdays.append(birthday)
-        structure.append(person)
-        details[detail["id"]] = detail
-        #print(json.dumps(person, sort_keys=True, indent=2, separators=(',', ': ')))
-        #print(json.dumps(detail, sort_keys=True, indent=2, separators=(',', ': ')))
-
-    # partition
-    partitions={}
-    for detailid, detaildata in details.items():
-        partitionid = abs(java_hashcode(detailid)) % args.partition_details
-        partition = partitions.setdefault(partitionid, {})
-        partition[detailid] = detaildata
-
-    # structure file
-    sort_name_index(structure)
-    with open(structure_outputfile,"w") as f:
-        json.dump(structure, f, **json_style)
+    # Structure partitions, and details partitions when partitioning by family,
+    # are consecutive runs of people in family order, so relatives end up together
+    position = {}
+    if args.partition_by == "family" or args.partition_structure > 1:
+        with metrics.stage("family_order"):
+            order = family_order(graph, remap)
+            position = dict((person_id, i) for (i, person_id) in enumerate(order))
+            people = len(order)
+            del order
+        metrics.count("family_order", people)
 
-    # birthdays file
-    sort_birthdays(birthdays)
-    with open(birthdays_outputfile, "w") as f:
-        json.dump(birthdays, f, **json_style)
+    new_files = {}
+    written = 0
+    removed = 0
+
+    if args.format == "columnar":
+        open_structure = lambda filename: ColumnWriter(filename, structure_columns, ["ids", "strings"], json_style)
+        add_person = lambda writer, person: writer.add(columnar_person(person, writer))
+        open_details = lambda filename: ColumnWriter(filename, details_columns, ["strings"], json_style)
+        add_detail = lambda writer, detail: writer.add(columnar_detail(detail, writer))
+    else:
+        open_structure = lambda filename: JsonWriter(filename, json_style).begin("[]")
+        add_person = lambda writer, person: writer.add(person)
+        open_details = lambda filename: JsonWriter(filename, json_style).begin("{}")
+        add_detail = lambda writer, detail: writer.add(detail, detail["id"])
+
+    # Each individual's details are written out as soon as they're made, and
+    # their structure entry goes to be sorted, so nobody's kept in memory
+    structure = ExternalSort(name_index_key, structure_outputfile)
+    details_writers = PartitionWriters(args.partition_details,
+        lambda partitionid: open_details(details_outputfile % partitionid), add_detail, details_outputfile % "-spool")
+    # Each citation goes to the table the first time anyone has it, and
+    # details only have its id
+    citation_writers = PartitionWriters(args.citation_table,
+        lambda partitionid: ColumnWriter(citations_outputfile % partitionid, citation_columns, ["titles"], json_style),
+        lambda writer, cite: writer.add([cite[0], writer.ref("titles", cite[1]), cite[2]]), citations_outputfile % "-spool")
+    citation_ids = set()
+    manifest_partitions = [[] for i in range(args.partition_details)]
+
+    # Each individual is timed where it's built, in the workers with --jobs
+    if args.jobs > 1:
+        results = process_parallel(search_set, gedcom.pointer_dict, graph, remap, args, old_fingerprints, metrics)
+    else:
+        results = metrics.timed_results("build_records",
+            (process_individual(individual, graph, remap, args, old_fingerprints, metrics) for individual in search_set))
+
+    with metrics.stage("records"):
+        for (person_id, fingerprint, records) in results:
+            if fingerprint is not None:
+                fingerprints[person_id] = fingerprint
+            if records is None:
+                records = (old_structure[person_id], old_details[person_id], old_birthdays.get(person_id))
+            else:
+                rebuilt += 1
+            (person, detail, birthday) = records
+
+            if args.citation_table:
+                cites = []
+                for cite in detail["cites"]:
+                    if isinstance(cite, str):
+                        (cite_id, (title, text)) = (cite, old_citations[cite])
+                    else:
+                        (title, text, cite_id) = cite
+                    cites.append(cite_id)
+                    if cite_id in citation_ids:
+                        continue
+                    citation_ids.add(cite_id)
+                    citation_writers.add(abs(java_hashcode(cite_id)) % args.citation_table, [cite_id, title, text])
+                detail["cites"] = cites
+
+            if initial_person is None:
+                initial_person = person['id']
+            if birthday is not None:
+                birthdays.append(birthday)
+            if args.search_index:
+                names.append((detail["id"], detail["names"]))
+            structure.add(person)
+            count += 1
+
+            if args.partition_by == "family":
+                partitionid = position[detail["id"]] * args.partition_details // people
+                manifest_partitions[partitionid].append(detail["id"])
+            else:
+                partitionid = abs(java_hashcode(detail["id"])) % args.partition_details
+            details_writers.add(partitionid, detail)
+            #print(json.dumps(person, sort_keys=True, indent=2, separators=(',', ': ')))
+            #print(json.dumps(detail, sort_keys=True, indent=2, separators=(',', ': ')))
+    metrics.count("records", count)
 
     # details files
-    for partitionid, partition in partitions.items():
-        with open(details_outputfile % partitionid,"w") as f:
-            json.dump(partition, f, **json_style)
+    with metrics.stage("write_details"):
+        written += details_writers.close(old_files, new_files, args.precompress)
+        if args.partition_by == "family":
+            written += write_json(partitions_outputfile, manifest_partitions, json_style, old_files, new_files, args.precompress)
+    metrics.count("write_details", details_writers.opened)
 
-    # config file
-    try:
-        with open(config_outputfile, "r") as f:
-            config = json.load(f);
-    except:
-        config = {}
-    config["initial_person"] = initial_person
-    config["partition_details"] = args.partition_details
-    config["created_date"] = datetime.datetime.now().strftime("%d %b %Y %H:%M:%S")
-    with open(config_outputfile, "w") as f:
-        json.dump(config, f, **json_style);
+    # citation table files
+    with metrics.stage("write_citations"):
+        written += citation_writers.close(old_files, new_files, args.precompress)
+    metrics.count("write_citations", len(citation_ids))
+
+    # structure files
+    name_order = [] # everyone's ids in the order of the structure file, for the narratives
+    with metrics.stage("write_structure"):
+        if args.partition_structure > 1:
+            # the viewer downloads every structure file, so they're all written, even if empty
+            structure_writers = PartitionWriters(args.partition_structure,
+                lambda partitionid: open_structure(structure_partition_outputfile % partitionid), add_person,
+                structure_partition_outputfile % "-spool", write_empty=True)
+            for person in structure.sorted():
+                structure_writers.add(position[person["id"]] * args.partition_structure // people, person)
+                if args.narratives:
+                    name_order.append(person["id"])
+            written += structure_writers.close(old_files, new_files, args.precompress)
+        else:
+            writer = open_structure(structure_outputfile)
+            for person in structure.sorted():
+                add_person(writer, person)
+                if args.narratives:
+                    name_order.append(person["id"])
+            written += writer.close(old_files, new_files, args.precompress)
+    metrics.count("write_structure", count)
+
+    # birthdays file
+    with metrics.stage("birthdays"):
+        sort_birthdays(birthdays)
+        written += write_json(birthdays_outputfile, birthdays, json_style, old_files, new_files, args.precompress)
+    metrics.count("birthdays", len(birthdays))
+
+    # search index files
+    search_shards = []
+    if args.search_index:
+        with metrics.stage("search_index"):
+            for (shardid, (prefix, shard)) in enumerate(search_index(names)):
+                search_shards.append(prefix)
+                written += write_json(search_outputfile % shardid, shard, json_style, old_files, new_files, args.precompress)
+        metrics.count("search_index", len(names))
+
+    # narratives files
+    if args.narratives:
+        with metrics.stage("narratives"):
+            with open(args.narratives, "r") as f:
+                narratives = json.load(f)
+            ids = remap(graph.pointers)
+            numbers = dict((person_id, number) for (number, person_id) in enumerate(ids))
+            members = []
+            for spec in narratives.get("spec", []):
+                indvs = narrative_members(spec, graph, ids, numbers)
+                if indvs is None:
+                    print("Narrative %s: dir should be \"up\" or \"down\"" % spec.get("name"))
+                members.append(indvs or [])
+            # everyone who isn't in any of them
+            included = set(entry["id"] for indvs in members for entry in indvs)
+            other = [person_id for person_id in name_order if person_id not in included]
+            narratives = {"spec": narratives.get("spec", []), "descs": narratives.get("descs", {})}
+            if args.partition_narratives:
+                narratives["partitioned"] = True
+                for (narrativeid, indvs) in enumerate(members):
+                    written += write_json(narrative_outputfile % narrativeid, indvs, json_style, old_files, new_files, args.precompress)
+                written += write_json(narrative_outputfile % "other", other, json_style, old_files, new_files, args.precompress)
+            else:
+                narratives["members"] = members
+                narratives["other"] = other
+            written += write_json(narratives_outputfile, narratives, json_style, old_files, new_files, args.precompress)
+        metrics.count("narratives", len(members))
+
+    # pictures file
+    if args.pictures:
+        with metrics.stage("pictures"):
+            individuals = gedcom.records('INDI') if args.stream else gedcom.all().tag('INDI').foreach()
+            (pictures_data, pictures_read) = build_pictures(individuals, remap, args.pictures, pictures_outputdir,
+                args.thumbnail_size, args.jobs)
+            written += write_json(pictures_outputfile, pictures_data, json_style, old_files, new_files, args.precompress)
+        metrics.count("pictures", pictures_read)
+
+    with metrics.stage("finish"):
+        for name in old_files:
+            if name not in new_files and (name.startswith("details") or name.startswith("structure") or
+                    name.startswith("search") or name.startswith("cites") or name == "partitions.json"):
+                os.remove(os.path.join(os.path.dirname(details_outputfile), name))
+                remove_compressed_files(os.path.join(os.path.dirname(details_outputfile), name))
+                removed += 1
+
+        # config file
+        config = read_json(config_outputfile, {})
+        old_config = dict(config)
+        config["initial_person"] = initial_person
+        config["partition_details"] = args.partition_details
+        config["partition_structure"] = args.partition_structure
+        config["partition_mode"] = args.partition_by
+        config["search_shards"] = search_shards
+        config["data_format"] = args.format
+        config["citation_table"] = args.citation_table
+        if not args.incremental or written or removed or config != old_config:
+            config["created_date"] = datetime.datetime.now().strftime("%d %b %Y %H:%M:%S")
+            write_file(config_outputfile, json.dumps(config, **json_style).encode('utf-8'))
+
+        # manifest file
+        if args.incremental:
+            manifest = {"version": manifest_version, "options": options, "records": fingerprints, "files": new_files}
+            write_file(manifest_outputfile, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+            print("Rebuilt %d of %d individuals, wrote %d of %d data files, removed %d" %
+                (rebuilt, count, written, len(new_files), removed))
+
+    if metrics.enabled:
+        report = metrics.report(args)
+        if args.metrics_out:
+            write_file(args.metrics_out, json.dumps(report, indent=2).encode('utf-8'))
+        elif args.profile:
+            for function in report["profile"]["functions"]:
+                print("%10.3f %10.3f %10d  %s" % (function["cumulative_s"], function["total_s"], function["calls"], function["function"]))
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except BaseException:
+        # the data files are all written in ../data (see main)
+        if os.path.isdir("../data"):
+            remove_temp_files("../data")
+        raise
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+"""
+Generate a synthetic GEDCOM file of any size, for testing and benchmarking.
+
+The tree grows from a few founding couples: each family has some children,
+most of whom marry someone from outside the tree and start a family of
+their own. Individuals have birth, death, residence and travel events with
+dates in the various GEDCOM forms, multiline notes, and citations of shared
+sources with transcriptions. The same arguments always give the same file.
+"""
+import argparse
+import math
+import random
+import sys
+from collections import deque
+
+given_names = {
+    "M": ["John", "William", "James", "George", "Charles", "Joseph", "Thomas", "Henry",
+        "Samuel", "David", "Jacob", "Isaac", "Abraham", "Michael", "Peter", "José",
+        "François", "Søren", "Jürgen", "Aleksander"],
+    "F": ["Mary", "Elizabeth", "Sarah", "Anna", "Margaret", "Catherine", "Rebecca", "Rachel",
+        "Hannah", "Esther", "Ruth", "Emma", "Clara", "Zoë", "Renée", "Åsa", "Małgorzata",
+        "Chloé", "Ingrid", "Rosa"],
+}
+surnames = ["Smith", "Cohen", "Miller", "Schmidt", "Novak", "García", "Müller", "Kowalski",
+    "van der Berg", "O'Brien", "Levy", "Johansson", "Fischer", "Rossi", "Dubois", "Nagy",
+    "Epstein", "Weiss", "Horvath", "Silva", "Jensen", "Martín", "Petrov", "Brown",
+    "Katz", "Schwartz", "Ødegaard", "Łukasiewicz", "Friedman", "Baker"]
+towns = ["Vilna", "Kovno", "Minsk", "Pinsk", "Bialystok", "Lodz", "Krakow", "Lemberg",
+    "Odessa", "Kiev", "Riga", "Warsaw", "Hamburg", "Bremen", "Liverpool", "Boston",
+    "New York", "Philadelphia", "Baltimore", "Chicago", "Montréal", "Buenos Aires",
+    "Cape Town", "Melbourne", "Tel Aviv"]
+regions = ["Vilna Governorate, Russian Empire", "Kovno Governorate, Russian Empire",
+    "Minsk Governorate, Russian Empire", "Galicia, Austria-Hungary", "Germany", "England",
+    "Massachusetts, USA", "New York, USA", "Pennsylvania, USA", "Maryland, USA",
+    "Illinois, USA", "Quebec, Canada", "Argentina", "South Africa", "Victoria, Australia"]
+months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+words = ["the", "family", "lived", "in", "a", "small", "house", "near", "river", "market",
+    "synagogue", "church", "worked", "as", "tailor", "merchant", "farmer", "teacher",
+    "emigrated", "with", "his", "her", "brother", "sister", "after", "war", "letters",
+    "describe", "years", "children", "moved", "city", "record", "shows", "son", "daughter"]
+
+# No one is born after this; families that would have children later have no more
+latest_birth = 2015
+# Anyone who'd die after this is still alive
+present_year = 2020
+
+class Tree(object):
+    """
+    The people and families of a synthetic tree, as parallel lists indexed
+    by number, so that even very large trees take little memory.
+    """
+    def __init__(self, individuals, rng):
+        self.rng = rng
+        self.sex = []
+        self.birth = []
+        self.surname = []
+        self.famc = []
+        self.fams = []
+        self.husband = []
+        self.wife = []
+        self.children = []
+        self.married = []
+
+        # Start early enough that the last generation isn't born in the future
+        generations = math.log(max(individuals, 2), 2.2)
+        start_year = int(1990 - 28 * generations)
+        founders = max(1, individuals // 5000)
+        queue = deque()
+        for i in range(founders):
+            if len(self.sex) + 2 > individuals:
+                break
+            year = start_year + rng.randint(-20, 20)
+            queue.append(self.add_family(
+                self.add_person("M", year, rng.randrange(len(surnames)), -1),
+                self.add_person("F", year + rng.randint(-5, 5), rng.randrange(len(surnames)), -1)))
+        while len(self.sex) < individuals:
+            if not queue:
+                # everyone died out; start another line
+                year = start_year + rng.randint(-20, 20)
+                queue.append(self.add_family(
+                    self.add_person("M", year, rng.randrange(len(surnames)), -1),
+                    self.add_person("F", year + rng.randint(-5, 5), rng.randrange(len(surnames)), -1)))
+                continue
+            family = queue.popleft()
+            parents_born = max(self.birth[self.husband[family]], self.birth[self.wife[family]])
+            for i in range(rng.choice([0, 1, 2, 2, 3, 3, 4, 5, 6])):
+                if len(self.sex) >= individuals:
+                    break
+                sex = rng.choice("MF")
+                born = parents_born + rng.randint(20, 40)
+                if born > latest_birth:
+                    continue
+                child = self.add_person(sex, born, self.surname[self.husband[family]], family)
+                self.children[family].append(child)
+                if len(self.sex) < individuals and rng.random() < 0.75:
+                    spouse = self.add_person("F" if sex == "M" else "M",
+                        min(self.birth[child] + rng.randint(-5, 5), latest_birth), rng.randrange(len(surnames)), -1)
+                    if sex == "M":
+                        queue.append(self.add_family(child, spouse))
+                    else:
+                        queue.append(self.add_family(spouse, child))
+
+    def add_person(self, sex, birth, surname, famc):
+        self.sex.append(sex)
+        self.birth.append(birth)
+        self.surname.append(surname)
+        self.famc.append(famc)
+        self.fams.append([])
+        return len(self.sex) - 1
+
+    def add_family(self, husband, wife):
+        family = len(self.husband)
+        self.husband.append(husband)
+        self.wife.append(wife)
+        self.children.append([])
+        self.married.append(min(max(self.birth[husband], self.birth[wife]) + self.rng.randint(18, 30), present_year))
+        self.fams[husband].append(family)
+        self.fams[wife].append(family)
+        return family
+
+def date(rng, year):
+    """
+    A date in the given year, in one of the forms seen in real GEDCOMs.
+    """
+    form = rng.random()
+    if form < 0.5:
+        return "%d %s %d" % (rng.randint(1, 28), rng.choice(months), year)
+    if form < 0.65:
+        return "%s %d" % (rng.choice(months), year)
+    if form < 0.8:
+        return "%d" % year
+    if form < 0.9:
+        return "ABT %d" % year
+    if form < 0.95:
+        return "BET %d AND %d" % (year, year + rng.randint(1, 5))
+    return rng.choice(["BEF", "AFT", "Abt."]) + " %d" % year
+
+def place(rng):
+    return "%s, %s" % (rng.choice(towns), rng.choice(regions))
+
+def text(rng, count):
+    return " ".join(rng.choice(words) for i in range(count))
+
+def long_text(level, tag, value, continuation_level=None, width=60):
+    """
+    The lines for a long value, split into CONC lines as GEDCOM requires.
+    These are a level below the value's line, unless continuation_level is given.
+    Values aren't split next to a space, since readers may strip it.
+    """
+    if continuation_level is None:
+        continuation_level = level + 1
+    chunks = []
+    start = 0
+    while start < len(value):
+        end = min(start + width, len(value))
+        while end < len(value) and end > start + 1 and (value[end - 1] == " " or value[end] == " "):
+            end -= 1
+        chunks.append(value[start:end])
+        start = end
+    lines = ["%d %s %s" % (level, tag, chunks[0])]
+    lines.extend("%d CONC %s" % (continuation_level, chunk) for chunk in chunks[1:])
+    return lines
+
+def citation(rng, level, sources):
+    lines = ["%d SOUR @S%d@" % (level, rng.randrange(sources)),
+        "%d PAGE Page %d" % (level + 1, rng.randint(1, 500)),
+        "%d DATA" % (level + 1)]
+    lines.extend(long_text(level + 2, "TEXT", text(rng, rng.randint(5, 40))))
+    return lines
+
+def event(rng, tag, year, sources, citations, event_type=None):
+    lines = ["1 %s" % tag]
+    if event_type is not None:
+        lines.append("2 TYPE %s" % event_type)
+    lines.append("2 DATE %s" % date(rng, year))
+    lines.append("2 PLAC %s" % place(rng))
+    if rng.random() < citations:
+        lines.extend(citation(rng, 2, sources))
+    return lines
+
+def write_gedcom(out, individuals, seed, events, notes, citations, sources):
+    rng = random.Random(seed)
+    tree = Tree(individuals, rng)
+    sources = sources or individuals // 50 + 1
+    out.write("0 HEAD\n1 SOUR make-test-gedcom\n1 GEDC\n2 VERS 5.5.1\n1 CHAR UTF-8\n")
+    for person in range(len(tree.sex)):
+        sex = tree.sex[person]
+        lines = ["0 @I%d@ INDI" % person,
+            "1 NAME %s /%s/" % (rng.choice(given_names[sex]), surnames[tree.surname[person]]),
+            "1 SEX %s" % sex]
+        born = tree.birth[person]
+        lines.extend(event(rng, "BIRT", born, sources, citations))
+        died = born + rng.randint(1, 95)
+        if died < present_year:
+            lines.extend(event(rng, "DEAT", died, sources, citations))
+        else:
+            died = max(born, present_year)
+        for i in range(rng.randint(0, 2 * events)):
+            year = rng.randint(born, died)
+            if rng.random() < 0.2:
+                lines.extend(event(rng, "EVEN", year, sources, citations, rng.choice(["Arrival", "Departure"])))
+            else:
+                lines.extend(event(rng, "RESI", year, sources, citations))
+        if tree.famc[person] >= 0:
+            lines.append("1 FAMC @F%d@" % tree.famc[person])
+        for family in tree.fams[person]:
+            lines.append("1 FAMS @F%d@" % family)
+        if rng.random() < notes:
+            lines.extend(long_text(1, "NOTE", text(rng, rng.randint(5, 80))))
+            for i in range(rng.randint(0, 3)):
+                lines.extend(long_text(2, "CONT", text(rng, rng.randint(3, 30)), 2))
+        if rng.random() < citations:
+            lines.extend(citation(rng, 1, sources))
+        out.write("\n".join(lines) + "\n")
+    for family in range(len(tree.husband)):
+        lines = ["0 @F%d@ FAM" % family,
+            "1 HUSB @I%d@" % tree.husband[family],
+            "1 WIFE @I%d@" % tree.wife[family]]
+        lines.extend("1 CHIL @I%d@" % child for child in tree.children[family])
+        lines.extend(event(rng, "MARR", tree.married[family], sources, citations))
+        if rng.random() < 0.03:
+            lines.extend(event(rng, "DIV", min(tree.married[family] + rng.randint(1, 20), present_year), sources, citations))
+        out.write("\n".join(lines) + "\n")
+    for source in range(sources):
+        out.write("0 @S%d@ SOUR\n1 TITL %s records of %s, %d-%d\n1 AUTH %s archive\n" % (source,
+            rng.choice(["Census", "Birth", "Marriage", "Death", "Passenger", "Naturalization"]),
+            rng.choice(towns), 1700 + source % 300, 1710 + source % 300, rng.choice(regions)))
+    out.write("0 TRLR\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic gedcom for testing and benchmarking")
+    parser.add_argument("--individuals", type=int, help="Number of individuals", default=1000)
+    parser.add_argument("--seed", type=int, help="Random seed; the same seed and options give the same file", default=1)
+    parser.add_argument("--events", type=int, help="Average number of residence and travel events per individual", default=2)
+    parser.add_argument("--notes", type=float, help="Fraction of individuals with a note", default=0.3)
+    parser.add_argument("--citations", type=float, help="Chance of each event having a source citation", default=0.5)
+    parser.add_argument("--sources", type=int, help="Number of sources (default: one per 50 individuals)", default=0)
+    parser.add_argument("--output", help="Output file (default: standard output)")
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            write_gedcom(out, args.individuals, args.seed, args.events, args.notes, args.citations, args.sources)
+    else:
+        write_gedcom(sys.stdout, args.individuals, args.seed, args.events, args.notes, args.citations, args.sources)
+
+if __name__ == "__main__":
+    main()
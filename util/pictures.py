@@ -0,0 +1,232 @@
+"""
+Pictures for the viewer: finding them in a directory, reading their
+dimensions from their headers without decoding them, and making the full
+size and thumbnail JPEGs that the viewer shows, named by a hash of the
+picture's contents.
+
+Making copies of pictures that aren't JPEGs, and making thumbnails, needs
+Pillow. Without it, JPEGs are copied as they are and serve as their own
+thumbnails, and other pictures are skipped.
+"""
+import hashlib
+import io
+import os
+import re
+import shutil
+import struct
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+picture_extensions = (".jpg", ".jpeg", ".png", ".gif", ".tif", ".tiff")
+
+# Bytes read from the start of a picture to tell its type
+header_size = 32
+
+# JPEG markers for the start of a frame, which has the dimensions
+jpeg_frame_markers = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# TIFF (and Exif) tags
+tiff_width = 256
+tiff_height = 257
+tiff_orientation = 274
+
+# Exif orientations in which the picture is turned on its side
+transposed_orientations = (5, 6, 7, 8)
+
+def scan_directory(directory):
+    """
+    Return a dict of the pictures under directory, for find_picture. Each
+    picture's (path, size, mtime_ns) is keyed by its path relative to the
+    directory, in lower case with / separators, and by each trailing part of
+    that path that isn't the whole path of another picture.
+    """
+    entries = []
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        with os.scandir(os.path.join(directory, relative)) as scan:
+            for entry in scan:
+                path = relative + entry.name
+                if entry.is_dir():
+                    pending.append(path + "/")
+                elif os.path.splitext(entry.name)[1].lower() in picture_extensions:
+                    stat = entry.stat()
+                    entries.append((path, stat.st_size, stat.st_mtime_ns))
+    entries.sort()
+    found = dict((entry[0].lower(), entry) for entry in entries)
+    for entry in entries:
+        parts = entry[0].lower().split("/")
+        for i in range(1, len(parts)):
+            found.setdefault("/".join(parts[i:]), entry)
+    return found
+
+def find_picture(found, filename):
+    """
+    Look up the file named in a gedcom in the result of scan_directory. Such
+    names are often absolute paths on another computer, so the longest
+    trailing part of the name that's found is used, down to just the file's
+    name, which matches a picture with that name in any subdirectory.
+    """
+    parts = [part for part in re.split(r"[\\/]", filename) if part not in ("", ".")]
+    for i in range(len(parts)):
+        entry = found.get("/".join(parts[i:]).lower())
+        if entry is not None:
+            return entry
+    return None
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:20]
+
+def tiff_tags(f, wanted):
+    """
+    Return the values of the wanted (short or long) tags in the first
+    directory of a TIFF file, or of the Exif data in a JPEG.
+    """
+    start = f.tell()
+    order = {b"II": "<", b"MM": ">"}.get(f.read(2))
+    if order is None:
+        return {}
+    (magic, offset) = struct.unpack(order + "HI", f.read(6))
+    f.seek(start + offset)
+    (count,) = struct.unpack(order + "H", f.read(2))
+    entries = f.read(count * 12)
+    values = {}
+    for i in range(len(entries) // 12):
+        (tag, kind, number, value) = struct.unpack_from(order + "HHI4s", entries, i * 12)
+        if tag in wanted and kind == 3:
+            values[tag] = struct.unpack_from(order + "H", value)[0]
+        elif tag in wanted and kind == 4:
+            values[tag] = struct.unpack_from(order + "I", value)[0]
+    return values
+
+def jpeg_size(f):
+    orientation = 1
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        marker = ord(marker or b"\xd9")
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        if marker in (0xD9, 0xDA):
+            # the end of the picture, or the start of its data, without a frame
+            return None
+        (length,) = struct.unpack(">H", f.read(2))
+        if marker in jpeg_frame_markers:
+            (precision, height, width) = struct.unpack(">BHH", f.read(5))
+            if orientation in transposed_orientations:
+                return (height, width)
+            return (width, height)
+        segment = f.read(length - 2)
+        if marker == 0xE1 and segment.startswith(b"Exif\0\0"):
+            orientation = tiff_tags(io.BytesIO(segment[6:]), (tiff_orientation,)).get(tiff_orientation, 1)
+
+def tiff_size(f):
+    f.seek(0)
+    values = tiff_tags(f, (tiff_width, tiff_height, tiff_orientation))
+    if tiff_width not in values or tiff_height not in values:
+        return None
+    if values.get(tiff_orientation) in transposed_orientations:
+        return (values[tiff_height], values[tiff_width])
+    return (values[tiff_width], values[tiff_height])
+
+def image_type(header):
+    if header.startswith(b"\xff\xd8"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+        return "png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] in (b"II*\0", b"MM\0*"):
+        return "tiff"
+    return None
+
+def image_size(filename):
+    """
+    Return the (width, height) of a JPEG, PNG, GIF or TIFF picture as it's
+    displayed (i.e. after any rotation in its Exif data), reading no more of
+    it than needed, or None if it's not a picture of those types.
+    """
+    with open(filename, "rb") as f:
+        header = f.read(header_size)
+        kind = image_type(header)
+        try:
+            if kind == "jpeg":
+                return jpeg_size(f)
+            if kind == "png":
+                return struct.unpack(">II", header[16:24])
+            if kind == "gif":
+                return struct.unpack("<HH", header[6:10])
+            if kind == "tiff":
+                return tiff_size(f)
+        except struct.error:
+            # cut short
+            return None
+    return None
+
+def save_image(image, filename, quality):
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(temp_filename, "JPEG", quality=quality)
+    os.replace(temp_filename, filename)
+
+def make_full_size(source, filename, kind):
+    if kind == "jpeg":
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        shutil.copyfile(source, temp_filename)
+        os.replace(temp_filename, filename)
+    else:
+        with Image.open(source) as image:
+            save_image(ImageOps.exif_transpose(image), filename, 90)
+
+def make_thumbnail(source, filename, size):
+    with Image.open(source) as image:
+        # JPEGs are only decoded at the smallest scale that's big enough
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        save_image(image, filename, 85)
+
+def process_picture(job):
+    """
+    Hash a picture and read its dimensions, and make its full size and
+    thumbnail JPEGs in output_dir if they aren't there already, or the
+    thumbnail in any case if remake_thumbnail (e.g. its size changed). Returns
+    (source, picture id, "WxH", error), where the error is None if it
+    worked. This is run in worker processes.
+    """
+    (source, output_dir, thumbnail_size, remake_thumbnail) = job
+    try:
+        with open(source, "rb") as f:
+            kind = image_type(f.read(header_size))
+        size = image_size(source)
+        if size is None:
+            return (source, None, None, "can't read its size; it may not be a JPEG, PNG, GIF or TIFF picture")
+        if kind != "jpeg" and Image is None:
+            return (source, None, None, "Pillow is needed to convert it to JPEG")
+        picid = file_hash(source)
+        full_size = os.path.join(output_dir, "f_%s.jpg" % picid)
+        thumbnail = os.path.join(output_dir, "t_%s.jpg" % picid)
+        if not os.path.exists(full_size):
+            make_full_size(source, full_size, kind)
+        if remake_thumbnail or not os.path.exists(thumbnail):
+            if Image is None:
+                shutil.copyfile(full_size, thumbnail)
+            else:
+                make_thumbnail(source, thumbnail, thumbnail_size)
+        return (source, picid, "%dx%d" % size, None)
+    except (OSError, ValueError) as e:
+        return (source, None, None, str(e))
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+"""
+Serve the family viewer and its data straight from a gedcom, instead of
+generating the files in data/ with make-data.py.
+
+The gedcom is parsed once, and the structure, birthdays and search files are
+made from it in memory. Each person's details are only built when the viewer
+asks for them, and the most recently used are kept in a cache, which suits
+very large trees where most people are never looked at. When the gedcom
+changes, it's loaded again.
+
+    ./serve-data.py --gedcom path/to/family.ged --note --citations
+    (then open http://localhost:8000/render.html)
+
+Generated files have ETags, so browsers can check whether their copy is
+current, and are gzipped for browsers that accept it. Everything else,
+including the viewer itself and the narratives and pictures files in data/,
+is served from the viewer's directory as usual.
+"""
+import argparse
+import datetime
+import functools
+import gc
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import jgedcom
+
+util_dir = os.path.dirname(os.path.abspath(__file__))
+
+def load_make_data():
+    spec = importlib.util.spec_from_file_location("make_data", os.path.join(util_dir, "make-data.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+make_data = load_make_data()
+
+# Responses smaller than this aren't worth compressing
+gzip_min_size = 1024
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def accepts_gzip(accept_encoding):
+    for coding in accept_encoding.split(","):
+        (name, semicolon, params) = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            q = params.replace(" ", "")
+            return not (q.startswith("q=0") and q.strip("q=0.") == "")
+    return False
+
+class Response(object):
+    """
+    A generated JSON file: its contents, their gzipped form (made the first
+    time it's wanted), and the ETags of both.
+    """
+    __slots__ = ('body', 'gzipped', 'etag')
+
+    def __init__(self, obj):
+        self.body = json.dumps(obj).encode('utf-8')
+        self.gzipped = None
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()[:20]
+
+    def compressed(self):
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body, mtime=0)
+        return self.gzipped
+
+    def etags(self):
+        return (self.etag, self.etag[:-1] + '-gz"')
+
+class TreeData(object):
+    """
+    Everything served for one version of the gedcom. The structure, birthdays,
+    search and config files are made when it's loaded; details are made when
+    they're asked for, and the cache_size most recently used are kept.
+    """
+    def __init__(self, filename, args):
+        self.args = args
+        self.signature = file_signature(filename)
+        gedcom = jgedcom.Gedcom(filename, storage="slots" if args.compact else "dict")
+        # The parsed gedcom is kept until it changes, so keep the garbage collector from scanning it
+        gc.freeze()
+        self.pointer_dict = gedcom.pointer_dict
+        self.remap = make_data.make_remap(gedcom.pointer_dict)
+        graph = gedcom.graph()
+
+        self.pointers = {} # output id -> gedcom pointer
+        people = []
+        birthdays = []
+        names = []
+        for individual in gedcom.all().tag('INDI').foreach():
+            (person, birthday) = make_data.build_person(individual, graph, self.remap)
+            self.pointers[person["id"]] = make_data.first(individual.pointer())
+            people.append(person)
+            if birthday is not None:
+                birthdays.append(birthday)
+            if args.search_index:
+                names.append((person["id"], individual.get_attr('NAME')))
+        initial_person = people[0]["id"] if people else None
+        people.sort(key=make_data.name_index_key)
+        make_data.sort_birthdays(birthdays)
+
+        self.files = {}
+        if args.partition_structure > 1:
+            # consecutive runs of people in family order, as in make-data.py
+            order = make_data.family_order(graph, self.remap)
+            position = dict((person_id, i) for (i, person_id) in enumerate(order))
+            parts = [[] for i in range(args.partition_structure)]
+            for person in people:
+                parts[position[person["id"]] * args.partition_structure // len(order)].append(person)
+            for (partitionid, part) in enumerate(parts):
+                self.files["structure%d.json" % partitionid] = Response(part)
+        else:
+            self.files["structure.json"] = Response(people)
+        self.files["birthdays.json"] = Response(birthdays)
+        search_shards = []
+        if args.search_index:
+            for (shardid, (prefix, shard)) in enumerate(make_data.search_index(names)):
+                search_shards.append(prefix)
+                self.files["search%d.json" % shardid] = Response(shard)
+        self.files["config.json"] = Response({
+            "initial_person": initial_person,
+            "partition_details": 1,
+            "partition_structure": args.partition_structure,
+            "partition_mode": "hash",
+            "search_shards": search_shards,
+            "data_format": "json",
+            "details_mode": "person",
+            "created_date": datetime.datetime.now().strftime("%d %b %Y %H:%M:%S"),
+        })
+
+        self.details = OrderedDict()
+        self.lock = threading.Lock()
+
+    def detail(self, person_id):
+        """
+        Return the Response with a person's details, or None if there's no such person.
+        """
+        with self.lock:
+            if person_id in self.details:
+                self.details.move_to_end(person_id)
+                return self.details[person_id]
+        if person_id not in self.pointers:
+            return None
+        individual = jgedcom.Selector(self.pointer_dict, [self.pointer_dict[self.pointers[person_id]]])
+        response = Response({person_id: make_data.build_detail(individual, self.remap, self.args)})
+        with self.lock:
+            self.details[person_id] = response
+            if len(self.details) > self.args.cache_size:
+                self.details.popitem(last=False)
+        return response
+
+class DataServer(ThreadingHTTPServer):
+    """
+    An HTTP server for the viewer's directory, with the data files made by a TreeData.
+    """
+    def __init__(self, address, args):
+        self.args = args
+        self.tree = TreeData(args.gedcom, args)
+        self.checked = time.monotonic()
+        self.reload_lock = threading.Lock()
+        ThreadingHTTPServer.__init__(self, address, functools.partial(DataRequestHandler, directory=args.root))
+
+    def current(self):
+        """
+        Return the current TreeData, loading it again first if the gedcom has
+        changed. If the new version can't be loaded (e.g. because it's still
+        being written), the old one is used until the next check.
+        """
+        if time.monotonic() - self.checked < self.args.reload_interval:
+            return self.tree
+        with self.reload_lock:
+            if time.monotonic() - self.checked >= self.args.reload_interval:
+                try:
+                    if file_signature(self.args.gedcom) != self.tree.signature:
+                        print("Reloading %s" % self.args.gedcom)
+                        self.tree = TreeData(self.args.gedcom, self.args)
+                except (OSError, ValueError) as e:
+                    print("Can't reload %s: %s" % (self.args.gedcom, e))
+                self.checked = time.monotonic()
+        return self.tree
+
+class DataRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves data/config.json, data/structure*.json, data/birthdays.json,
+    data/search*.json and data/details/<id>.json from the server's TreeData,
+    and anything else from the viewer's directory.
+    """
+    def do_GET(self):
+        if not self.send_generated(head=False):
+            SimpleHTTPRequestHandler.do_GET(self)
+
+    def do_HEAD(self):
+        if not self.send_generated(head=True):
+            SimpleHTTPRequestHandler.do_HEAD(self)
+
+    def send_generated(self, head):
+        """
+        Send the response for a generated file, returning False if the path isn't one.
+        """
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith("/data/"):
+            return False
+        name = path[len("/data/"):]
+        tree = self.server.current()
+        if name.startswith("details/") and name.endswith(".json"):
+            response = tree.detail(urllib.parse.unquote(name[len("details/"):-len(".json")]))
+            if response is None:
+                self.send_error(HTTPStatus.NOT_FOUND, "No such person")
+                return True
+        else:
+            response = tree.files.get(name)
+            if response is None:
+                return False
+
+        (etag, gzip_etag) = response.etags()
+        if_none_match = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+        if "*" in if_none_match or etag in if_none_match or gzip_etag in if_none_match:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return True
+
+        body = response.body
+        compress = len(body) >= gzip_min_size and accepts_gzip(self.headers.get("Accept-Encoding", ""))
+        if compress:
+            body = response.compressed()
+            etag = gzip_etag
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+        return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the family viewer with data made on demand from a gedcom")
+    parser.add_argument("--gedcom", help="Source gedcom file", default="../../genealogy/Family Tree.ged")
+    parser.add_argument("--citations", help="Include citation transcriptions", action="store_true")
+    parser.add_argument("--note", help="Include notes on individuals from gedcom", action="store_true")
+    parser.add_argument("--partition-structure", type=int, help="Split the structure into several files, which are downloaded in parallel", default=1)
+    parser.add_argument("--search-index", help="Serve an index of names, so the viewer can search without scanning every name", action="store_true")
+    parser.add_argument("--compact", help="Store the parsed gedcom in compact objects rather than dicts, to save memory", action="store_true")
+    parser.add_argument("--cache-size", type=int, help="Number of people whose details are kept in memory", default=10000)
+    parser.add_argument("--reload-interval", type=float, help="Seconds between checks for changes to the gedcom", default=2.0)
+    parser.add_argument("--root", help="The viewer's directory", default=os.path.dirname(util_dir))
+    parser.add_argument("--bind", help="Address to listen on", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port to listen on", default=8000)
+    # details are always built with the citations in them
+    parser.set_defaults(citation_table=0)
+    args = parser.parse_args()
+
+    server = DataServer((args.bind, args.port), args)
+    print("Serving %s at http://%s:%d/render.html" % (args.gedcom, args.bind, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()